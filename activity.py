@@ -0,0 +1,199 @@
+from array import array
+from itertools import compress
+
+MINUTE = 60
+HOUR = 3600
+# Per-minute buckets cover the 1h window (plus the partial minute at its start),
+# per-hour buckets the longer ones (14d plus a day of slack).
+MINUTE_SLOTS = 61
+HOUR_SLOTS = 15 * 24
+
+
+def _new_ring(size):
+    return array('I', bytes(4 * size))
+
+
+def _ring_sum(ring, head, first):
+    """Sums the buckets of a ring whose absolute index is in [first, head]."""
+    size = len(ring)
+    k = min(head - first + 1, size)
+    if k <= 0:
+        return 0
+    end = head % size + 1
+    if k <= end:
+        return sum(ring[end - k:end])
+    return sum(ring[:end]) + sum(ring[size - (k - end):])
+
+
+def _ring_add(ring, head, index, n):
+    """Adds n to bucket `index`, advancing the ring if needed. Returns the new head."""
+    size = len(ring)
+    if head is None or index - head >= size:
+        for i in range(size):
+            ring[i] = 0
+        head = index
+    elif index > head:
+        for i in range(head + 1, index + 1):
+            ring[i % size] = 0
+        head = index
+    elif index <= head - size:
+        # Older than the ring covers; nothing to record.
+        return head
+    ring[index % size] += n
+    return head
+
+
+def _ring_items(ring, head):
+    """Returns [(absolute_index, count), ...] for the non-empty buckets of a ring, oldest first."""
+    size = len(ring)
+    end = head % size + 1
+    offset = head - end + 1     # absolute index of slot 0
+    # compress() skips the empty slots in C; most of a ring is usually empty.
+    slots = list(compress(range(end, size), ring[end:])) + list(compress(range(end), ring))
+    return [(offset + slot - (size if slot >= end else 0), ring[slot]) for slot in slots]
+
+
+def _ring_from_pairs(pairs, size):
+    """Builds a ring from stored [absolute_index, count] pairs. Returns (ring, head)."""
+    ring = _new_ring(size)
+    head = int(max(pairs)[0])
+    first = head - size
+    for index, count in pairs:
+        if index > first:
+            ring[int(index) % size] += int(count)
+    return ring, head
+
+
+class ActivityHistogram:
+    """Fixed-size per-user message activity: per-minute buckets for the last hour
+    and per-hour buckets for the last HOUR_SLOTS hours.
+
+    Windowed counts are a sum over at most HOUR_SLOTS buckets, whatever the
+    user's history size. Windows longer than an hour are resolved to the hour,
+    so the oldest bucket may include up to an hour of messages from before the
+    cutoff.
+    """
+
+    __slots__ = ("minutes", "minute_head", "hours", "hour_head")
+
+    def __init__(self):
+        self.minutes = None
+        self.minute_head = None
+        self.hours = None
+        self.hour_head = None
+
+    def add(self, ts, n=1):
+        """Records n messages sent at Unix time ts."""
+        if self.minutes is None:
+            self.minutes = _new_ring(MINUTE_SLOTS)
+        if self.hours is None:
+            self.hours = _new_ring(HOUR_SLOTS)
+        self.minute_head = _ring_add(self.minutes, self.minute_head, int(ts // MINUTE), n)
+        self.hour_head = _ring_add(self.hours, self.hour_head, int(ts // HOUR), n)
+
+    def count_since(self, threshold):
+        """Returns the number of messages sent at or after Unix time threshold."""
+        if self.hour_head is None:
+            return 0
+        minute = int(threshold // MINUTE)
+        if minute > self.minute_head - MINUTE_SLOTS:
+            return _ring_sum(self.minutes, self.minute_head, minute) if self.minutes is not None else 0
+        if self.hours is None:
+            return 0
+        return _ring_sum(self.hours, self.hour_head, int(threshold // HOUR))
+
+    def is_empty(self):
+        return self.hours is None or not any(self.hours)
+
+    def expire(self, now):
+        """Releases ring arrays whose buckets are all older than they can cover."""
+        if self.minutes is not None and int(now // MINUTE) - self.minute_head >= MINUTE_SLOTS:
+            self.minutes = None
+        if self.hours is not None and int(now // HOUR) - self.hour_head >= HOUR_SLOTS:
+            self.hours = None
+
+    def trim(self, threshold):
+        """Clears the hourly buckets for hours that started before `threshold`
+        and returns them as [(hour_start_ts, count), ...], oldest first."""
+        if self.hours is None:
+            return []
+        first = int(threshold // HOUR)
+        removed = []
+        for index, count in _ring_items(self.hours, self.hour_head):
+            if index >= first:
+                break
+            removed.append((index * HOUR, count))
+            self.hours[index % HOUR_SLOTS] = 0
+        return removed
+
+    def minute_buckets(self):
+        """Yields (minute_start_ts, count) for every non-empty per-minute bucket."""
+        if self.minutes is not None:
+            for index, count in _ring_items(self.minutes, self.minute_head):
+                yield index * MINUTE, count
+
+    def hour_buckets(self):
+        """Yields (hour_start_ts, count) for every non-empty hourly bucket."""
+        if self.hours is not None:
+            for index, count in _ring_items(self.hours, self.hour_head):
+                yield index * HOUR, count
+
+    def events(self):
+        """Yields (bucket_start_ts, count) at the finest resolution held: minutes
+        where the minute ring still covers them, hours otherwise."""
+        minute_totals = {}
+        if self.minutes is not None:
+            for index, count in _ring_items(self.minutes, self.minute_head):
+                minute_totals[index * MINUTE // HOUR] = minute_totals.get(index * MINUTE // HOUR, 0) + count
+                yield index * MINUTE, count
+        for start, count in self.hour_buckets():
+            remaining = count - minute_totals.get(start // HOUR, 0)
+            if remaining > 0:
+                yield start, remaining
+
+    def copy(self):
+        """Cheap snapshot: the rings are copied as arrays, without walking them."""
+        clone = ActivityHistogram()
+        clone.minutes = array('I', self.minutes) if self.minutes is not None else None
+        clone.minute_head = self.minute_head
+        clone.hours = array('I', self.hours) if self.hours is not None else None
+        clone.hour_head = self.hour_head
+        return clone
+
+    def to_dict(self):
+        """Serializes only the non-empty buckets as [absolute_index, count] pairs."""
+        data = {}
+        if self.minutes is not None:
+            data["m"] = [[i, c] for i, c in _ring_items(self.minutes, self.minute_head)]
+        if self.hours is not None:
+            data["h"] = [[i, c] for i, c in _ring_items(self.hours, self.hour_head)]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls.from_buckets(data.get("h"), data.get("m"))
+
+    @classmethod
+    def from_buckets(cls, hours, minutes=None, minute_head=None):
+        """Builds a histogram from (absolute_index, count) pairs per hour and,
+        optionally, per minute around the newest message. Without minutes,
+        `minute_head` is the minute up to which there were none."""
+        hist = cls()
+        if hours:
+            hist.hours, hist.hour_head = _ring_from_pairs(hours, HOUR_SLOTS)
+        if minutes:
+            hist.minutes, hist.minute_head = _ring_from_pairs(minutes, MINUTE_SLOTS)
+        elif minute_head is not None:
+            hist.minute_head = minute_head
+        elif hist.hour_head is not None:
+            # No recent minutes recorded; anchor the minute ring at the end of the newest hour.
+            hist.minute_head = (hist.hour_head + 1) * (HOUR // MINUTE) - 1
+        return hist
+
+    @classmethod
+    def from_timestamps(cls, timestamps):
+        """Builds a histogram from a legacy list of message timestamps."""
+        hist = cls()
+        for ts in sorted(timestamps):
+            hist.add(float(ts))
+        return hist
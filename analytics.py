@@ -0,0 +1,146 @@
+"""Activity analytics over the stored histograms and daily rollups.
+
+Everything is binned with NumPy: the hourly rings of many users are stacked
+into one 2-D array per chunk and reduced with `bincount`, so the cost grows
+with the number of users, not the number of messages.
+"""
+import asyncio
+
+import numpy as np
+
+from activity import HOUR, HOUR_SLOTS
+from compaction import EVENT_RETENTION
+
+DAY = 86400
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+# Analytics windows in days; hour-of-day patterns use at most the hourly history.
+WINDOWS = {"7d": 7, "14d": 14, "30d": 30, "90d": 90, "365d": 365}
+USERS_PER_CHUNK = 4096
+SHADES = " ░▒▓█"
+SPARKS = "▁▂▃▄▅▆▇█"
+
+
+def _hourly_chunk(histograms, first_hour, length):
+    """Sums a chunk of histograms' hourly buckets into one series starting at first_hour."""
+    hists = [h for h in histograms if h.hours is not None]
+    if not hists:
+        return np.zeros(length, dtype=np.int64)
+    rings = np.frombuffer(b"".join(h.hours.tobytes() for h in hists), dtype=np.uint32).reshape(len(hists), HOUR_SLOTS)
+    heads = np.fromiter((h.hour_head for h in hists), dtype=np.int64, count=len(hists))
+    # Absolute hour held by each slot of each ring.
+    hours = heads[:, None] - ((heads[:, None] - np.arange(HOUR_SLOTS)) % HOUR_SLOTS)
+    offsets = hours - first_hour
+    mask = (rings > 0) & (offsets >= 0) & (offsets < length)
+    return np.bincount(offsets[mask], weights=rings[mask], minlength=length).astype(np.int64)
+
+async def hourly_series(histograms, first_hour, last_hour):
+    """Total messages per hour for first_hour..last_hour (absolute hour indexes).
+    Yields to the event loop between chunks of USERS_PER_CHUNK histograms."""
+    length = last_hour - first_hour + 1
+    series = np.zeros(length, dtype=np.int64)
+    for start in range(0, len(histograms), USERS_PER_CHUNK):
+        series += _hourly_chunk(histograms[start:start + USERS_PER_CHUNK], first_hour, length)
+        await asyncio.sleep(0)
+    return series
+
+def rollup_arrays(daily):
+    """Flattens {user_id: {day: count}} rollups into (days, counts) arrays."""
+    days = np.fromiter((day for per_user in daily.values() for day in per_user), dtype=np.int64)
+    counts = np.fromiter((n for per_user in daily.values() for n in per_user.values()), dtype=np.int64, count=len(days))
+    return days, counts
+
+def rows_to_arrays(rows):
+    """Converts [(day, count), ...] rows (e.g. from SQLite) into (days, counts) arrays."""
+    table = np.asarray(rows, dtype=np.int64).reshape(-1, 2)
+    return table[:, 0], table[:, 1]
+
+
+class ActivityReport:
+    """Heatmap, daily trend and peaks for one guild (or user) over a window."""
+
+    def __init__(self, window_days, heatmap, heatmap_days, first_day, trend, peak_hour, offset_hours):
+        self.window_days = window_days
+        self.heatmap = heatmap              # 7 x 24 array: weekday (Mon=0) x local hour
+        self.heatmap_days = heatmap_days    # most recent local days behind the heatmap
+        self.first_day = first_day          # day index (days since the epoch) of trend[0]
+        self.trend = trend                  # messages per day
+        self.peak_hour = peak_hour          # (hour start ts, count) of the busiest single hour, or None
+        self.offset_hours = offset_hours
+
+    @property
+    def total(self):
+        return int(self.trend.sum())
+
+    def busiest_slots(self, n=3):
+        """The n busiest (weekday, hour, count) heatmap cells."""
+        flat = self.heatmap.ravel()
+        top = np.argsort(flat)[::-1][:n]
+        return [(int(i) // 24, int(i) % 24, int(flat[i])) for i in top if flat[i] > 0]
+
+    def busiest_day(self):
+        if not self.trend.any():
+            return None
+        i = int(np.argmax(self.trend))
+        return (self.first_day + i) * DAY, int(self.trend[i])
+
+
+async def build_report(histograms, window_days, now, rollups=None, offset_hours=0):
+    """Builds an ActivityReport from hourly histograms plus, for windows longer than
+    the hourly history, daily rollups given as (days, counts) arrays. The window is
+    the last window_days local calendar days, today included, for the heatmap and
+    the trend alike. Hourly data is only used back to the compaction threshold,
+    which is where rollups take over; the day on that boundary may be slightly
+    undercounted."""
+    last_hour = int(now // HOUR)
+    last_day = (last_hour + offset_hours) // 24
+    first_day = last_day - window_days + 1
+    first_hour = max(first_day * 24 - offset_hours, last_hour - EVENT_RETENTION // HOUR + 1)
+    series = await hourly_series(histograms, first_hour, last_hour)
+
+    # Shift to local time; weekday 0 is Monday and the epoch was a Thursday.
+    local_hours = np.arange(first_hour, last_hour + 1) + offset_hours
+    local_days = local_hours // 24
+    heatmap_days = min(window_days, 14)
+    recent = local_days > last_day - heatmap_days
+    cells = ((local_days[recent] + 3) % 7) * 24 + local_hours[recent] % 24
+    heatmap = np.bincount(cells, weights=series[recent], minlength=7 * 24).astype(np.int64).reshape(7, 24)
+
+    trend = np.bincount(local_days - first_day, weights=series, minlength=window_days).astype(np.int64)
+    if rollups is not None and len(rollups[0]):
+        # Rollups are whole UTC days and only fill in days older than the hourly history.
+        days, counts = rollups
+        hourly_start = int(local_days[0])
+        offsets = days - first_day
+        keep = (offsets >= 0) & (days < hourly_start)
+        trend += np.bincount(offsets[keep], weights=counts[keep], minlength=window_days).astype(np.int64)[:window_days]
+
+    peak_hour = None
+    if series.any():
+        i = int(np.argmax(series))
+        peak_hour = ((first_hour + i) * HOUR, int(series[i]))
+    return ActivityReport(window_days, heatmap, heatmap_days, first_day, trend, peak_hour, offset_hours)
+
+
+def render_heatmap(heatmap):
+    """Renders a 7 x 24 heatmap as text, one shade character per hour."""
+    top = heatmap.max()
+    levels = np.zeros_like(heatmap) if not top else np.ceil(heatmap * (len(SHADES) - 1) / top).astype(int)
+    lines = ["    " + "".join(str(h // 10) if h % 6 == 0 else " " for h in range(24)),
+             "    " + "".join(str(h % 10) if h % 6 == 0 else " " for h in range(24))]
+    for weekday, row in enumerate(levels):
+        lines.append(f"{WEEKDAYS[weekday]} " + "".join(SHADES[level] for level in row))
+    return "\n".join(lines)
+
+def render_sparkline(values):
+    top = values.max() if len(values) else 0
+    if not top:
+        return SPARKS[0] * len(values)
+    return "".join(SPARKS[int(v * (len(SPARKS) - 1) // top)] for v in values)
+
+def render_trend(trend, width=60):
+    """Sparkline of daily totals, summed into at most `width` columns."""
+    if len(trend) > width:
+        per_column = -(-len(trend) // width)
+        padded = np.concatenate([np.zeros(per_column * width - len(trend), dtype=trend.dtype), trend])
+        trend = padded.reshape(width, per_column).sum(axis=1)
+    return render_sparkline(trend)
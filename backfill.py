@@ -0,0 +1,250 @@
+"""Rebuilds message counts from channel history.
+
+A backfill pages through the history of every text channel in a guild, a
+bounded number of channels at a time, and adds each message sent before the
+guild's `last_reset` to its counts; messages after that were already counted
+live. Progress is checkpointed per channel alongside the counts themselves,
+so an interrupted backfill resumes where it stopped instead of counting
+anything twice.
+
+Run it from the bot with /backfill, or offline (with the bot stopped):
+
+    python backfill.py <guild_id> [--concurrency 4]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import discord
+from dotenv import load_dotenv
+
+from activity import ActivityHistogram, HOUR, HOUR_SLOTS
+from compaction import add_rollup
+from guild_config import GuildConfig
+from ranking import get_rankings
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000       # messages counted per checkpoint
+
+
+class BackfillCancelled(Exception):
+    """Raised when a guild's counts were reset while its backfill was running."""
+
+
+def new_state(cutoff, channels):
+    return {
+        "cutoff": cutoff,
+        "started": time.time(),
+        "finished": None,
+        "messages": 0,
+        "channels": {str(c.id): {"before": None, "messages": 0, "done": False} for c in channels},
+    }
+
+
+def summarize_state(state, errors=0):
+    channels = state["channels"].values()
+    return {
+        "messages": state["messages"],
+        "channels_done": sum(1 for c in channels if c["done"]),
+        "channels": len(state["channels"]),
+        "started": state["started"],
+        "finished": state["finished"],
+        "errors": errors,
+    }
+
+
+class Backfill:
+    """One guild's backfill. Counts go through the guild cache (and, for
+    SQLite, the storage writer queue) exactly like live messages, and the
+    progress state is stored in the guild's data under "backfill"."""
+
+    def __init__(self, guild_cache, storage, guild_id, channels, config=None,
+                 concurrency=4, batch_size=BATCH_SIZE):
+        self.guild_cache = guild_cache
+        self.storage = storage
+        self.guild_id = str(guild_id)
+        self.config = config or GuildConfig()
+        self.channels = [c for c in channels if c.id not in self.config.excluded_channels]
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.errors = 0
+        self.state = None
+
+    async def prepare(self):
+        """Picks up an unfinished backfill for the same cutoff, or starts a new one.
+        Returns False if history before the cutoff has already been counted."""
+        data = await self.guild_cache.load(self.guild_id)
+        state = data.get("backfill")
+        if state is None or state["cutoff"] != data["last_reset"]:
+            state = new_state(data["last_reset"], self.channels)
+            self._set_state(data, state)
+        elif state["finished"]:
+            return False
+        for channel in self.channels:
+            state["channels"].setdefault(str(channel.id), {"before": None, "messages": 0, "done": False})
+        self.state = state
+        return True
+
+    def _set_state(self, data, state):
+        data["backfill"] = state
+        if self.storage.persists_increments:
+            self.storage.record_messages(self.guild_id, [], checkpoint=json.loads(json.dumps(state)))
+        else:
+            self.guild_cache.mark_dirty(self.guild_id)
+
+    def progress(self):
+        return summarize_state(self.state, self.errors)
+
+    async def run(self):
+        if self.state is None and not await self.prepare():
+            return self.progress()
+        pending = asyncio.Queue()
+        for channel in self.channels:
+            if not self.state["channels"][str(channel.id)]["done"]:
+                pending.put_nowait(channel)
+        workers = [asyncio.create_task(self._worker(pending)) for _ in range(min(self.concurrency, pending.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        if all(c["done"] for c in self.state["channels"].values()):
+            self.state["finished"] = time.time()
+            self._set_state(await self.guild_cache.load(self.guild_id), self.state)
+            logger.info(f"Backfill of guild {self.guild_id} finished: {self.state['messages']} message(s)")
+        return self.progress()
+
+    async def _worker(self, pending):
+        while not pending.empty():
+            channel = pending.get_nowait()
+            try:
+                await self._backfill_channel(channel)
+            except discord.Forbidden:
+                logger.info(f"Backfill: no access to history of channel {channel.id}; skipping it")
+                await self._apply(channel.id, [], None, done=True)
+            except discord.HTTPException as e:
+                # Left unfinished; the next run resumes from its checkpoint.
+                self.errors += 1
+                logger.error(f"Backfill of channel {channel.id} stopped: {e}")
+
+    async def _backfill_channel(self, channel):
+        checkpoint = self.state["channels"][str(channel.id)]["before"]
+        before = discord.Object(id=checkpoint) if checkpoint else datetime.fromtimestamp(self.state["cutoff"], timezone.utc)
+        rows = []
+        scanned = 0
+        last_id = None
+        # Newest first, so each checkpoint is simply the oldest message seen so far.
+        async for message in channel.history(limit=None, before=before, oldest_first=False):
+            last_id = message.id
+            scanned += 1
+            if not message.author.bot and self.config.counts(message):
+                rows.append((str(message.author.id), int(message.created_at.timestamp()), 1))
+            if scanned >= self.batch_size:
+                await self._apply(channel.id, rows, last_id)
+                rows, scanned = [], 0
+        await self._apply(channel.id, rows, last_id, done=True)
+
+    async def _apply(self, channel_id, rows, last_id, done=False):
+        """Adds one batch to the guild's counts and moves the channel's checkpoint, together."""
+        data = await self.guild_cache.load(self.guild_id)
+        state = data.get("backfill")
+        if state is None or state["cutoff"] != self.state["cutoff"]:
+            raise BackfillCancelled(f"Counts for guild {self.guild_id} were reset during the backfill")
+        self.state = state
+
+        counts = data["counts"]
+        activity = data["activity"]
+        rankings = get_rankings(data)
+        horizon = time.time() - HOUR_SLOTS * HOUR
+        new_entries = 0
+        for user_id, ts, n in rows:
+            if user_id not in counts:
+                new_entries += 1
+            counts[user_id] = counts.get(user_id, 0) + n
+            rankings.record(user_id, n, ts)
+            if ts >= horizon:
+                hist = activity.get(user_id)
+                if hist is None:
+                    hist = activity[user_id] = ActivityHistogram()
+                    new_entries += 1
+                hist.add(ts, n)
+            elif not self.storage.persists_increments:
+                # SQLite keeps every row as an event and rolls it up itself; JSON only has the
+                # histograms, so messages too old for them go straight into the daily rollups.
+                daily = data.setdefault("daily", {})
+                if user_id not in daily:
+                    new_entries += 1
+                add_rollup(daily, user_id, ts, n)
+
+        channel = state["channels"].setdefault(str(channel_id), {"before": None, "messages": 0, "done": False})
+        if last_id is not None:
+            channel["before"] = last_id
+        channel["messages"] += len(rows)
+        channel["done"] = channel["done"] or done
+        state["messages"] += len(rows)
+
+        if self.storage.persists_increments:
+            self.storage.record_messages(self.guild_id, rows, checkpoint=json.loads(json.dumps(state)))
+            self.guild_cache.add_weight(self.guild_id, new_entries)
+        else:
+            self.guild_cache.mark_dirty(self.guild_id, weight_delta=new_entries)
+
+
+async def run_offline(guild_id, token, concurrency):
+    """Backfills one guild over the REST API only, writing straight to storage."""
+    from guild_cache import GuildCache
+    from storage import create_storage
+
+    storage = create_storage(os.getenv('STORAGE_BACKEND', 'json'), path=os.getenv('SQLITE_PATH', 'strack.db'))
+    storage.start()
+    guild_cache = GuildCache(storage.load_guild, storage.save_guild)
+    client = discord.Client(intents=discord.Intents.none())
+    try:
+        await client.login(token)
+        guild = await client.fetch_guild(guild_id)
+        channels = [c for c in await guild.fetch_channels() if isinstance(c, discord.TextChannel)]
+        configs = storage.load_configs()
+        if str(guild_id) in configs:
+            config = GuildConfig.from_dict(configs[str(guild_id)])
+        else:
+            legacy = int(os.getenv('EXCLUDED_CHANNEL_ID', 0))
+            config = GuildConfig(excluded_channels={legacy} if legacy else ())
+        job = Backfill(guild_cache, storage, guild_id, channels, config, concurrency=concurrency)
+        if not await job.prepare():
+            logger.info(f"History before the last reset of guild {guild_id} has already been counted")
+            return
+        flusher = asyncio.create_task(_flush_periodically(guild_cache))
+        try:
+            progress = await job.run()
+        finally:
+            flusher.cancel()
+            await guild_cache.flush()
+        logger.info(f"{progress['messages']} message(s) counted, {progress['channels_done']}/{progress['channels']} channel(s) done")
+    finally:
+        await client.close()
+        await asyncio.to_thread(storage.close)
+
+async def _flush_periodically(guild_cache, interval=10):
+    while True:
+        await asyncio.sleep(interval)
+        await guild_cache.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Count a guild's message history (run with the bot stopped)")
+    parser.add_argument('guild_id', type=int)
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BACKFILL_CONCURRENCY', 4)),
+                        help="channels read at the same time")
+    args = parser.parse_args()
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        logger.error("BOT_TOKEN not found in .env file. Please set the environment variable.")
+    else:
+        asyncio.run(run_offline(args.guild_id, token, args.concurrency))
@@ -0,0 +1,225 @@
+"""Offline benchmark for Strack's hot paths.
+
+Builds a synthetic guild (members, roles, historical message counts), then
+drives the real code paths with fake Discord objects: storage load/save,
+on_message ingestion, and the /leaderboard and /rolecount ranking and page
+rendering. Nothing touches the network. Results are written as JSON so runs
+from different versions can be compared.
+
+    python benchmark.py --members 100000 --history 50000000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import discord_bot
+from activity import ActivityHistogram, HOUR
+from guild_cache import GuildCache
+from ranking import TIMEFRAMES, get_rankings
+from storage import create_storage, serialize_message_counts
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_us": round(percentile(latencies, 50) * 1e6, 2),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 2),
+        "max_us": round(latencies[-1] * 1e6, 2) if latencies else 0.0,
+    }
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+# ---------------------- FAKE DISCORD OBJECTS ----------------------
+class FakeBotUser:
+    id = 1
+    avatar = None
+    default_avatar = SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png")
+
+    def mentioned_in(self, message):
+        return False
+
+def make_guild(guild_id, member_count, role_count, rng):
+    roles = [SimpleNamespace(id=guild_id + 1 + i, name=f"Role {i}", position=i) for i in range(role_count)]
+    members = []
+    for i in range(member_count):
+        member_id = guild_id + 10_000 + i
+        # Everyone has @everyone-like role 0, plus a few random others.
+        member_roles = [roles[0]] + rng.sample(roles[1:], k=min(3, role_count - 1))
+        members.append(SimpleNamespace(id=member_id, bot=False, roles=member_roles,
+                                       display_name=f"member{i}", mention=f"<@{member_id}>"))
+    by_id = {m.id: m for m in members}
+    roles_by_id = {r.id: r for r in roles}
+    return SimpleNamespace(id=guild_id, name="Benchmark Guild", icon=None, shard_id=0, members=members, roles=roles,
+                           get_member=by_id.get, get_role=roles_by_id.get)
+
+def make_history(guild, history, now, rng):
+    """Spreads `history` messages over the guild's members with a heavy-tailed distribution."""
+    weights = [1.0 / (rank + 1) ** 1.1 for rank in range(len(guild.members))]
+    scale = history / sum(weights)
+    counts = {}
+    activity = {}
+    for member, weight in zip(guild.members, weights):
+        count = int(weight * scale)
+        if not count:
+            continue
+        uid = str(member.id)
+        counts[uid] = count
+        # Roughly a tenth of each user's messages fall in the last two weeks, in a few busy hours.
+        recent = max(1, count // 10)
+        hist = activity[uid] = ActivityHistogram()
+        for _ in range(min(recent, 24)):
+            hist.add(now - rng.uniform(0, 14 * 24 * HOUR), max(1, recent // 24))
+    return {"counts": counts, "activity": activity, "last_reset": int(now)}
+
+def make_message(guild, member, channel, created_at):
+    return SimpleNamespace(author=member, guild=guild, channel=channel, created_at=created_at,
+                           content="hello", mentions=[], role_mentions=[], mention_everyone=False)
+
+
+# ---------------------- BENCHMARKS ----------------------
+def bench_storage(storage, guild_id, data):
+    serialized, serialize_s = timed(serialize_message_counts, data)
+    start = time.perf_counter()
+    storage.save_guild(guild_id, serialized)
+    if storage.persists_increments:
+        # SQLite writes are queued; include the time until the writer has committed them.
+        storage.wait_for_guild(guild_id)
+    save_s = time.perf_counter() - start
+    loaded, load_s = timed(storage.load_guild, guild_id)
+    return loaded, {"serialize_s": round(serialize_s, 4), "save_s": round(save_s, 4), "load_s": round(load_s, 4)}
+
+async def bench_ingestion(guild, messages, rng):
+    channel = SimpleNamespace(id=guild.id + 5)
+    members = guild.members
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(messages):
+        # Skew live traffic towards the most active members, like real chat.
+        member = members[min(len(members) - 1, int(rng.paretovariate(1.2)) - 1)]
+        message = make_message(guild, member, channel, datetime.now(timezone.utc))
+        t = time.perf_counter()
+        await discord_bot.on_message(message)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    await discord_bot.guild_cache.flush()
+    return {"messages": messages, "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(messages / elapsed, 1), "on_message": summarize(latencies)}
+
+def bench_leaderboards(guild, repeats):
+    results = {}
+    data = discord_bot.guild_cache.get(str(guild.id))
+    data.pop("rankings", None)
+    _, build_s = timed(get_rankings, data)
+    results["ranking_index_build_s"] = round(build_s, 5)
+    for timeframe in TIMEFRAMES:
+        _, cold = timed(discord_bot.render_leaderboard_page, guild, timeframe, 0)
+        warm = [timed(discord_bot.render_leaderboard_page, guild, timeframe, 0)[1] for _ in range(repeats)]
+        deep = [timed(discord_bot.render_leaderboard_page, guild, timeframe, 1_000_000)[1] for _ in range(repeats)]
+        results[timeframe] = {"cold_s": round(cold, 5), "warm": summarize(warm), "last_page": summarize(deep)}
+    return results
+
+def bench_rolecount(guild, repeats):
+    discord_bot.role_indexes.pop(guild.id, None)
+    _, build_s = timed(discord_bot.get_role_index, guild)
+    lookups = [timed(discord_bot.resolve_role_from_input, guild, f"role {i % len(guild.roles)}")[1] for i in range(repeats)]
+    renders = []
+    for role in guild.roles[:repeats]:
+        renders.append(timed(discord_bot.render_leaderboard_page, guild, f"role-{role.id}", 0)[1])
+    return {"role_index_build_s": round(build_s, 4), "resolve_role": summarize(lookups), "role_page": summarize(renders)}
+
+async def run(args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    workdir = tempfile.mkdtemp(prefix='strack-bench-')
+    storage = create_storage(args.backend, path=os.path.join(workdir, 'strack.db'), directory=workdir)
+    storage.start()
+
+    # Point the bot at the benchmark's storage and keep command parsing (discord.py, not Strack) out of it.
+    discord_bot.storage = storage
+    discord_bot.guild_cache = GuildCache(storage.load_guild, storage.save_guild,
+                                         max_entries=discord_bot.CACHE_MAX_ENTRIES,
+                                         dirty_threshold=discord_bot.CACHE_DIRTY_THRESHOLD)
+    discord_bot.bot._connection.user = FakeBotUser()
+    async def process_commands(message):
+        pass
+    discord_bot.bot.process_commands = process_commands
+
+    guild, build_s = timed(make_guild, 900_000_000_000_000_000, args.members, args.roles, rng)
+    data, history_s = timed(make_history, guild, args.history, now, rng)
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": datetime.now(timezone.utc).isoformat(),
+        "params": vars(args),
+        "setup": {"guild_build_s": round(build_s, 3), "history_build_s": round(history_s, 3),
+                  "tracked_users": len(data["counts"])},
+    }
+    _, report["storage"] = bench_storage(storage, str(guild.id), data)
+    report["storage"]["file_bytes"] = sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir))
+    report["ingestion"] = await bench_ingestion(guild, args.messages, rng)
+    report["leaderboard"] = bench_leaderboards(guild, args.repeats)
+    report["rolecount"] = bench_rolecount(guild, args.repeats)
+    storage.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of Strack's message and leaderboard code paths")
+    parser.add_argument('--members', type=int, default=10_000, help="members in the synthetic guild")
+    parser.add_argument('--roles', type=int, default=50, help="roles in the synthetic guild")
+    parser.add_argument('--history', type=int, default=1_000_000, help="historical messages already counted")
+    parser.add_argument('--messages', type=int, default=50_000, help="live messages pushed through on_message")
+    parser.add_argument('--repeats', type=int, default=50, help="repetitions for per-query latency figures")
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
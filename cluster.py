@@ -0,0 +1,198 @@
+"""Runs Strack as several processes, each owning a range of gateway shards.
+
+    python cluster.py --shards 16 --processes 4
+    python cluster.py --shards auto
+
+Every worker is a normal `discord_bot.py` process started with SHARD_COUNT,
+SHARD_IDS, CLUSTER_ID and CLUSTER_COUNT set. Discord sends a guild's events to
+one shard only, so each guild is counted by exactly one worker; use the SQLite
+backend so all workers share one database for counts and timers. Workers that
+exit are restarted with backoff, and per-shard health and message throughput
+are read from each worker's /metrics endpoint and logged.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discord_bot.py')
+# Discord allows max_concurrency IDENTIFYs per 5 seconds; leave a little slack.
+IDENTIFY_INTERVAL = 5.5
+MAX_RESTART_DELAY = 300
+
+
+def shard_ranges(shard_count, processes):
+    """Splits shards 0..shard_count-1 into `processes` contiguous, near-equal ranges."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        stop = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, stop)))
+        start = stop
+    return ranges
+
+def recommended_sharding(token):
+    """Asks Discord for the recommended shard count and IDENTIFY concurrency."""
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot',
+                                     headers={'Authorization': f'Bot {token}', 'User-Agent': 'Strack cluster launcher'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        info = json.load(response)
+    return info['shards'], info.get('session_start_limit', {}).get('max_concurrency', 1)
+
+def scrape_shards(port):
+    """Reads the strack_shard_* series from a worker's /metrics endpoint as {shard: {metric: value}}."""
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        text = response.read().decode()
+    shards = {}
+    for line in text.splitlines():
+        if not line.startswith('strack_shard_'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, _, labels = series.partition('{')
+        shard = labels.split('shard="', 1)[1].split('"', 1)[0]
+        shards.setdefault(int(shard), {})[name] = float(value)
+    return shards
+
+
+class Worker:
+    def __init__(self, cluster_id, cluster_count, shard_count, shard_ids, metrics_port):
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.metrics_port = metrics_port
+        self.process = None
+        self.restarts = 0
+        self.restart_at = 0
+        self.started_at = 0
+
+    def start(self):
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.shard_count),
+                   SHARD_IDS=','.join(map(str, self.shard_ids)),
+                   CLUSTER_ID=str(self.cluster_id),
+                   CLUSTER_COUNT=str(self.cluster_count),
+                   METRICS_PORT=str(self.metrics_port))
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started_at = time.monotonic()
+        logger.info(f"Started cluster {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]}, "
+                    f"pid {self.process.pid}, metrics port {self.metrics_port})")
+
+    def check(self):
+        """Restarts the worker with exponential backoff if it has exited."""
+        if self.process is None or self.process.poll() is None:
+            return
+        now = time.monotonic()
+        if not self.restart_at:
+            # A worker that ran for a while before dying starts the backoff over.
+            if now - self.started_at > MAX_RESTART_DELAY:
+                self.restarts = 0
+            delay = min(MAX_RESTART_DELAY, 2 ** self.restarts)
+            logger.error(f"Cluster {self.cluster_id} exited with code {self.process.returncode}; restarting in {delay}s")
+            self.restart_at = now + delay
+        elif now >= self.restart_at:
+            self.restarts += 1
+            self.restart_at = 0
+            self.start()
+
+    def stop(self, timeout=30):
+        if self.process is None or self.process.poll() is not None:
+            return
+        # SIGINT lets discord_bot.py close the gateway and flush its caches.
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.error(f"Cluster {self.cluster_id} did not stop in {timeout}s; killing it")
+            self.process.kill()
+
+
+def report(workers, previous, interval):
+    """Logs one line per shard: state, latency, guilds and messages per second since the last report."""
+    current = {}
+    for worker in workers:
+        try:
+            shards = scrape_shards(worker.metrics_port)
+        except Exception as e:
+            logger.warning(f"Cluster {worker.cluster_id}: metrics unavailable ({e})")
+            continue
+        for shard_id, values in sorted(shards.items()):
+            messages = values.get('strack_shard_messages_total', 0)
+            current[shard_id] = messages
+            rate = (messages - previous[shard_id]) / interval if shard_id in previous else 0
+            state = 'up' if values.get('strack_shard_up') else 'DOWN'
+            logger.info(f"Cluster {worker.cluster_id} shard {shard_id}: {state}, "
+                        f"{values.get('strack_shard_latency_seconds', 0) * 1000:.0f}ms, "
+                        f"{values.get('strack_shard_guilds', 0):.0f} guilds, {rate:.1f} msg/s")
+    return current
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run Strack as several sharded worker processes")
+    parser.add_argument('--shards', default='auto', help="total shard count, or 'auto' to ask Discord")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('METRICS_PORT', 9464) or 9464),
+                        help="metrics port of worker 0; worker N uses this + N")
+    parser.add_argument('--report-interval', type=float, default=60, help="seconds between health reports (0 = off)")
+    args = parser.parse_args()
+
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        logger.error("BOT_TOKEN not found in .env file. Please set the environment variable.")
+        sys.exit(1)
+    if os.getenv('STORAGE_BACKEND', 'json') != 'sqlite':
+        logger.warning("STORAGE_BACKEND is not 'sqlite'; timers will be kept per worker. SQLite is recommended for clusters.")
+
+    max_concurrency = 1
+    if args.shards == 'auto':
+        shard_count, max_concurrency = recommended_sharding(token)
+    else:
+        shard_count = int(args.shards)
+    ranges = shard_ranges(shard_count, args.processes)
+    logger.info(f"Running {shard_count} shard(s) across {len(ranges)} process(es)")
+    workers = [Worker(i, len(ranges), shard_count, shard_ids, args.metrics_port + i) for i, shard_ids in enumerate(ranges)]
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Stagger start-up so the workers' IDENTIFYs stay inside Discord's rate limit.
+    for worker in workers:
+        if stopping:
+            break
+        worker.start()
+        time.sleep(IDENTIFY_INTERVAL * math.ceil(len(worker.shard_ids) / max_concurrency))
+
+    previous = {}
+    last_report = time.monotonic()
+    while not stopping:
+        time.sleep(1)
+        for worker in workers:
+            worker.check()
+        if args.report_interval and time.monotonic() - last_report >= args.report_interval:
+            previous = report(workers, previous, time.monotonic() - last_report)
+            last_report = time.monotonic()
+
+    logger.info("Stopping workers...")
+    for worker in workers:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
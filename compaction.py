@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+
+from activity import HOUR
+from ranking import TIMEFRAMES
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+# Per-message detail is kept for the longest leaderboard window plus some slack, so
+# buckets are folded into rollups well before they would fall off a histogram's ring.
+EVENT_RETENTION = max(TIMEFRAMES.values()) + 12 * HOUR
+USERS_PER_STEP = 5000   # histograms compacted between yields to the event loop
+
+
+def add_rollup(daily, user_id, ts, n):
+    days = daily.get(user_id)
+    if days is None:
+        days = daily[user_id] = {}
+    day = int(ts // DAY)
+    days[day] = days.get(day, 0) + n
+
+
+async def compact_guild_data(data, now, rollup_retention_days=0, keep_rollups=True):
+    """Folds a resident guild's expiring hourly activity into daily per-user
+    rollups (data["daily"]), drops empty histograms and expired rollup days.
+    With keep_rollups=False the expiring buckets are only dropped, for backends
+    that roll up their own copy of the events. `counts` is never touched.
+    Yields to the event loop every USERS_PER_STEP users."""
+    stats = {"buckets": 0, "messages": 0, "histograms": 0, "rollup_days": 0}
+    activity = data["activity"]
+    daily = data.setdefault("daily", {}) if keep_rollups else {}
+    threshold = now - EVENT_RETENTION
+    for i, user_id in enumerate(list(activity)):
+        if i and i % USERS_PER_STEP == 0:
+            await asyncio.sleep(0)
+        hist = activity.get(user_id)
+        if hist is None:
+            continue
+        for start, count in hist.trim(threshold):
+            if keep_rollups:
+                add_rollup(daily, user_id, start, count)
+            stats["buckets"] += 1
+            stats["messages"] += count
+        hist.expire(now)
+        if hist.is_empty():
+            del activity[user_id]
+            stats["histograms"] += 1
+
+    if rollup_retention_days:
+        first_day = int(now // DAY) - rollup_retention_days
+        for user_id in list(daily):
+            days = daily[user_id]
+            expired = [day for day in days if day < first_day]
+            for day in expired:
+                del days[day]
+            stats["rollup_days"] += len(expired)
+            if not days:
+                del daily[user_id]
+    if not data.get("daily"):
+        data.pop("daily", None)
+    return stats
+
+
+class Compactor:
+    """Background retention pass over every guild, one guild at a time.
+
+    Resident guilds have their in-memory histograms trimmed and folded into
+    daily rollups. Guilds that aren't cached are compacted on disk as well:
+    JSON files are loaded, compacted and written back from worker threads, and
+    backends that keep raw events (SQLite) fold and expire them in place.
+    """
+
+    def __init__(self, guild_cache, storage, rollup_retention_days=0, owns=None):
+        self.guild_cache = guild_cache
+        self.storage = storage
+        self.rollup_retention_days = rollup_retention_days
+        self.owns = owns        # with storage shared between processes, picks this process's guilds
+        self.totals = {"buckets": 0, "messages": 0, "histograms": 0, "rollup_days": 0, "events": 0, "rollup_rows": 0}
+        self.runs = 0
+        self.last_run = None
+
+    async def run_once(self):
+        """Compacts every guild once and returns what this pass reclaimed."""
+        now = time.time()
+        reclaimed = dict.fromkeys(self.totals, 0)
+        keep_rollups = not self.storage.persists_increments
+        for guild_id in self.guild_cache.resident_ids():
+            data = self.guild_cache.peek(guild_id)
+            if data is None:
+                continue
+            stats = await compact_guild_data(data, now, self.rollup_retention_days, keep_rollups)
+            for key, value in stats.items():
+                reclaimed[key] += value
+            if guild_id in self.guild_cache and (stats["buckets"] or stats["histograms"] or stats["rollup_days"]):
+                # Histograms only reach disk via snapshots in JSON mode; SQLite keeps its own events.
+                if not self.storage.persists_increments:
+                    self.guild_cache.mark_dirty(guild_id, weight_delta=-stats["histograms"])
+                else:
+                    self.guild_cache.add_weight(guild_id, -stats["histograms"])
+            await asyncio.sleep(0)
+
+        if not self.storage.persists_increments:
+            await self._compact_cold_guilds(now, reclaimed)
+        else:
+            rollup_before = int(now // DAY) - self.rollup_retention_days if self.rollup_retention_days else None
+            for guild_id in await asyncio.to_thread(self.storage.guild_ids):
+                if self.owns is not None and not self.owns(guild_id):
+                    continue
+                events, rows = await asyncio.to_thread(self.storage.compact, guild_id, now - EVENT_RETENTION, rollup_before)
+                reclaimed["events"] += events
+                reclaimed["rollup_rows"] += rows
+
+        for key, value in reclaimed.items():
+            self.totals[key] += value
+        self.runs += 1
+        self.last_run = now
+        return reclaimed
+
+    async def _compact_cold_guilds(self, now, reclaimed):
+        """Compacts the stored copy of every guild that isn't in the cache (JSON storage)."""
+        for guild_id in await asyncio.to_thread(self.storage.guild_ids):
+            if guild_id in self.guild_cache or (self.owns is not None and not self.owns(guild_id)):
+                continue
+            version = await asyncio.to_thread(self.storage.guild_version, guild_id)
+            data = await asyncio.to_thread(self.storage.load_guild, guild_id)
+            stats = await compact_guild_data(data, now, self.rollup_retention_days, keep_rollups=True)
+            if not (stats["buckets"] or stats["histograms"] or stats["rollup_days"]):
+                continue
+            unchanged = lambda: self.storage.guild_version(guild_id) == version
+            if await self.guild_cache.save_cold(guild_id, data, unchanged):
+                for key, value in stats.items():
+                    reclaimed[key] += value
@@ -1,37 +1,316 @@
+"""Offline maintenance for the message_counts_<guild_id>.json files.
+
+Checks every guild file in parallel (one process per CPU by default) with
+the same normalization the bot applies when it loads a guild, so damaged or
+old-format files can be fixed before startup instead of on the hot path:
+
+    python create_message_counts.py scan                   # report problems, change nothing
+    python create_message_counts.py repair                 # fix problems and rewrite files compactly
+    python create_message_counts.py migrate --to sqlite    # copy all guilds into strack.db
+    python create_message_counts.py migrate --to json      # and back out of it
+
+Migrations carry guild configs and pending timers across along with the counts.
+
+Repairs coerce counts to non-negative integers, fold legacy per-user
+timestamp lists into activity histograms and daily rollups (dropping duplicate timestamps),
+merge duplicate rollup days and drop entries that can't be read. Files that
+aren't valid JSON at all are renamed to *.corrupt for manual inspection; the
+bot starts such guilds from scratch either way. Run it with the bot stopped.
+"""
+import argparse
 import json
-import os
-from datetime import datetime, timezone
 import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from activity import HOUR, HOUR_SLOTS
+from storage import (JSON_SEPARATORS, MESSAGE_COUNTS_PATTERN, JsonStorage, SqliteStorage, get_message_counts_file,
+                     normalize_message_counts, serialize_message_counts)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# File path
-MESSAGE_COUNTS_FILE = 'message_counts.json'
-
-# Function to create message_counts.json with sample data
-def create_message_counts_file():
-    # Sample data with current timestamp (12:41 PM IST, September 7, 2025)
-    sample_data = {
-        "counts": {
-            "123456789012345678": 10,
-            "987654321098765432": 5,
-            "456789123456789123": 20
-        },
-        "last_reset": 1733639460  # 12:41 PM IST, September 7, 2025 (UTC timestamp)
-    }
+KNOWN_KEYS = {"counts", "activity", "last_reset", "daily", "backfill", "timestamps"}
+
+
+def _as_count(value):
+    """Returns value as a non-negative int, or None if it can't be one."""
+    if isinstance(value, bool):
+        return None
+    try:
+        n = int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return n if n >= 0 else None
+
+def _is_user_id(key):
+    return isinstance(key, str) and key.isdigit()
+
+def _valid_pairs(pairs):
+    """Keeps the [int, non-negative int] pairs of a stored bucket or rollup list."""
+    if not isinstance(pairs, list):
+        return None
+    kept = []
+    for pair in pairs:
+        if isinstance(pair, list) and len(pair) == 2 and isinstance(pair[0], int) and _as_count(pair[1]) is not None:
+            kept.append((pair[0], _as_count(pair[1])))
+    return kept
+
+def clean_message_counts(raw, issues, now=None):
+    """Returns a copy of a loaded guild file that normalize_message_counts can
+    read without losing anything it doesn't have to. Every fix is tallied in
+    `issues` (a Counter)."""
+    if not isinstance(raw, dict):
+        issues["not an object"] += 1
+        raw = {}
+    data = {}
+    for key in raw.keys() - KNOWN_KEYS:
+        issues[f"unknown key '{key}'"] += 1
+
+    counts = raw.get("counts", {})
+    if not isinstance(counts, dict):
+        issues["counts not an object"] += 1
+        counts = {}
+    data["counts"] = {}
+    for uid, value in counts.items():
+        n = _as_count(value)
+        if not _is_user_id(uid) or n is None:
+            issues["invalid count"] += 1
+            continue
+        if n != value:
+            issues["non-integer count"] += 1
+        data["counts"][uid] = n
+
+    last_reset = raw.get("last_reset")
+    if isinstance(last_reset, bool) or not isinstance(last_reset, (int, float)) or last_reset <= 0:
+        issues["missing last_reset"] += 1
+        last_reset = int(now or time.time())
+    data["last_reset"] = int(last_reset)
+
+    activity = raw.get("activity", {})
+    if not isinstance(activity, dict):
+        issues["activity not an object"] += 1
+        activity = {}
+    data["activity"] = {}
+    for uid, hist in activity.items():
+        if not _is_user_id(uid) or not isinstance(hist, dict):
+            issues["invalid activity"] += 1
+            continue
+        cleaned = {}
+        for ring in ("m", "h"):
+            if ring not in hist:
+                continue
+            pairs = _valid_pairs(hist[ring])
+            if pairs is None or len(pairs) != len(hist[ring]):
+                issues["invalid activity bucket"] += 1
+            if pairs:
+                if pairs != sorted(pairs):
+                    issues["unsorted activity buckets"] += 1
+                cleaned[ring] = sorted(pairs)
+        if cleaned:
+            data["activity"][uid] = cleaned
+
+    timestamps = raw.get("timestamps")
+    if timestamps is not None:
+        issues["legacy timestamps"] += 1
+        legacy = {}
+        for uid, ts in (timestamps.items() if isinstance(timestamps, dict) else ()):
+            values = ts if isinstance(ts, list) else [ts] if ts else []
+            values = [float(t) for t in values if isinstance(t, (int, float)) and not isinstance(t, bool)]
+            unique = sorted(set(values))
+            issues["duplicate timestamps"] += len(values) - len(unique)
+            if _is_user_id(uid) and unique:
+                legacy[uid] = unique
+        data["timestamps"] = legacy
+
+    daily = raw.get("daily")
+    if daily is not None:
+        data["daily"] = {}
+        for uid, days in (daily.items() if isinstance(daily, dict) else ()):
+            pairs = _valid_pairs(days) if _is_user_id(uid) else None
+            if pairs is None or len(pairs) != len(days):
+                issues["invalid rollup"] += 1
+            merged = {}
+            for day, n in pairs or ():
+                if day in merged:
+                    issues["duplicate rollup day"] += 1
+                merged[day] = merged.get(day, 0) + n
+            if merged:
+                data["daily"][uid] = sorted(merged.items())
 
+    if isinstance(raw.get("backfill"), dict):
+        data["backfill"] = raw["backfill"]
+    return data
+
+def dump_message_counts(data):
+    return json.dumps(serialize_message_counts(data), separators=JSON_SEPARATORS)
+
+
+# ---------------------- WORKERS ----------------------
+# These run in the process pool, so they take and return plain values.
+def check_file(path, repair=False):
+    """Validates one guild file and, with repair=True, rewrites it if anything
+    changed. Returns a summary dict."""
+    result = {"path": path, "before": os.path.getsize(path), "after": None, "users": 0,
+              "issues": Counter(), "status": "ok"}
+    try:
+        with open(path, 'rb') as f:
+            original = f.read()
+        raw = json.loads(original)
+    except (OSError, ValueError) as e:
+        result["issues"]["unreadable"] += 1
+        result["status"] = "corrupt"
+        result["error"] = str(e)
+        if repair:
+            os.replace(path, path + '.corrupt')
+            result["status"] = "quarantined"
+        return result
+
+    data = normalize_message_counts(clean_message_counts(raw, result["issues"]))
+    result["users"] = len(data["counts"])
+    compact = dump_message_counts(data).encode()
+    result["after"] = len(compact)
+    if compact != original:
+        result["status"] = "changed"
+        if repair:
+            temp_file = path + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(compact)
+            os.replace(temp_file, path)
+            result["status"] = "rewritten"
+    return result
+
+def load_repaired(path):
+    """Reads and repairs one guild file for migration; returns (path, serialized data or None, issues)."""
+    issues = Counter()
+    try:
+        with open(path, 'r') as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        issues["unreadable"] += 1
+        return path, None, issues
+    return path, serialize_message_counts(normalize_message_counts(clean_message_counts(raw, issues))), issues
+
+
+def guild_files(directory):
+    source = JsonStorage(directory)
+    return [get_message_counts_file(guild_id, directory) for guild_id in sorted(source.guild_ids(), key=int)]
+
+def _pool_map(fn, items, jobs):
+    """Maps fn over items in a process pool, in order, with a bounded number of
+    files in flight so results don't pile up in memory."""
+    window = max(1, jobs) * 4
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = []
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+# ---------------------- COMMANDS ----------------------
+def scan(directory, repair, jobs):
+    paths = guild_files(directory)
+    totals = Counter()
+    issues = Counter()
+    statuses = Counter()
+    started = time.monotonic()
+    for i, result in enumerate(_pool_map(partial(check_file, repair=repair), paths, jobs), 1):
+        totals["before"] += result["before"]
+        totals["after"] += result["after"] if result["after"] is not None else result["before"]
+        totals["users"] += result["users"]
+        issues.update(result["issues"])
+        statuses[result["status"]] += 1
+        if result["status"] in ("corrupt", "quarantined"):
+            logger.error(f"{result['path']}: {result['error']}" + (" (moved to .corrupt)" if repair else ""))
+        elif result["issues"]:
+            logger.info(f"{result['path']}: " + ", ".join(f"{name} ×{n}" for name, n in result["issues"].items()))
+        if i % 1000 == 0:
+            logger.info(f"{i}/{len(paths)} file(s) checked")
+
+    elapsed = time.monotonic() - started
+    print(f"{len(paths)} guild file(s), {totals['users']:,} user(s), checked in {elapsed:.1f}s with {jobs} process(es)")
+    print("  " + ", ".join(f"{status}: {n}" for status, n in sorted(statuses.items())) if statuses else "  nothing to do")
+    for name, n in issues.most_common():
+        print(f"  {name}: {n:,}")
+    if totals["before"]:
+        verb = "now" if repair else "would be"
+        print(f"  size: {totals['before']:,} bytes, {verb} {totals['after']:,} bytes "
+              f"({100 * (totals['after'] - totals['before']) / totals['before']:+.1f}%)")
+
+def migrate_to_sqlite(directory, db_path, jobs):
+    target = SqliteStorage(db_path)
+    target.start()
+    migrated = skipped = 0
     try:
-        if os.path.exists(MESSAGE_COUNTS_FILE):
-            logger.info(f"{MESSAGE_COUNTS_FILE} already exists, overwriting with sample data")
-        with open(MESSAGE_COUNTS_FILE, 'w') as f:
-            json.dump(sample_data, f, indent=4)
-        logger.info(f"Created {MESSAGE_COUNTS_FILE} with sample data")
-    except PermissionError as e:
-        logger.error(f"PermissionError saving {MESSAGE_COUNTS_FILE}: {e}")
-    except Exception as e:
-        logger.error(f"Error creating {MESSAGE_COUNTS_FILE}: {e}")
+        for path, data, issues in _pool_map(load_repaired, guild_files(directory), jobs):
+            if data is None:
+                logger.error(f"Skipping unreadable {path}")
+                skipped += 1
+                continue
+            guild_id = MESSAGE_COUNTS_PATTERN.search(path).group(1)
+            target.save_guild(guild_id, normalize_message_counts(data))
+            migrated += 1
+        source = JsonStorage(directory)
+        for guild_id, config in source.load_configs().items():
+            target.save_config(guild_id, config)
+        timers = source.load_timers()
+        for timer in timers:
+            target.add_timer(timer)
+    finally:
+        target.close()
+    print(f"Migrated {migrated} guild file(s) and {len(timers)} timer(s) into {db_path}"
+          + (f", skipped {skipped} unreadable" if skipped else ""))
+
+def migrate_to_json(directory, db_path):
+    source = SqliteStorage(db_path)
+    target = JsonStorage(directory)
+    size = 0
+    guild_ids = source.guild_ids()
+    try:
+        for guild_id in guild_ids:
+            # Events too old for the guild's hourly histograms go into its daily rollups.
+            now = time.time()
+            data = source.load_guild(guild_id, now=now)
+            data.pop("backfill", None)
+            daily = source.load_rollups(guild_id, events_before=int(now) - HOUR_SLOTS * HOUR)
+            if daily:
+                data["daily"] = daily
+            target.save_guild(guild_id, serialize_message_counts(data))
+            size += os.path.getsize(get_message_counts_file(guild_id, directory))
+        for guild_id, config in source.load_configs().items():
+            target.save_config(guild_id, config)
+        timers = source.load_timers()
+        for timer in timers:
+            target.add_timer(timer)
+    finally:
+        source.close()
+    print(f"Wrote {len(guild_ids)} guild file(s) ({size:,} bytes) and {len(timers)} timer(s) to {directory}")
+
 
 if __name__ == "__main__":
-    create_message_counts_file()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Validate, repair and migrate Strack's guild data files")
+    parser.add_argument('command', choices=('scan', 'repair', 'migrate'))
+    parser.add_argument('--directory', default='.', help="folder with the message_counts_<guild_id>.json files")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--to', choices=('sqlite', 'json'), help="migration target")
+    parser.add_argument('--db', default=os.getenv('SQLITE_PATH', 'strack.db'), help="SQLite database to migrate to or from")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.command == 'migrate':
+        if args.to == 'sqlite':
+            migrate_to_sqlite(args.directory, args.db, args.jobs)
+        elif args.to == 'json':
+            migrate_to_json(args.directory, args.db)
+        else:
+            parser.error("migrate needs --to sqlite or --to json")
+    else:
+        scan(args.directory, args.command == 'repair', args.jobs)
@@ -1,13 +1,33 @@
 import discord
-from discord.ext import commands
-import json
+from discord.ext import commands, tasks
 import os
+import math
 import time
 import asyncio
 import random
 from datetime import datetime, timezone
 import logging
+import hashlib
+import json
+import tempfile
+from typing import Literal
 from dotenv import load_dotenv
+from guild_cache import GuildCache
+from activity import ActivityHistogram
+from storage import create_storage
+from ranking import TIMEFRAMES, get_rankings
+from event_log import EventLog
+from page_cache import PageCache
+from role_index import RoleIndex
+from member_names import MemberNameCache, missing_members, resolve_members
+from guild_config import GuildConfig, GuildConfigStore
+from timers import TimerScheduler, TimerLimitError
+from backfill import Backfill, BackfillCancelled, summarize_state
+from compaction import Compactor
+from analytics import WINDOWS, WEEKDAYS, build_report, render_heatmap, render_trend, rollup_arrays, rows_to_arrays
+from export import PART_SIZE, export_guild
+from dispatch import Dispatcher, NOTIFY, REPLY
+from metrics import MetricsRegistry, Profiler, start_http_server, timed
 
 # ---------------------- SETUP ----------------------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,12 +38,68 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.messages = True
-bot = commands.Bot(command_prefix='/', intents=intents)
 
-# Per-guild message counts will be stored in files like 'message_counts_123456789.json'
-BOT_LOGS_FILE = 'bot_logs.json'
+# MEMBER_CACHE=lazy skips downloading every guild's member list at startup; leaderboards
+# then look up only the members on the page being shown.
+MEMBER_CACHE = os.getenv('MEMBER_CACHE', 'full')
+MEMBER_NAME_TTL = float(os.getenv('MEMBER_NAME_TTL', 3600))
+# The activity is sent with every IDENTIFY, so it needs no change_presence call after reconnects.
+bot_options = {"chunk_guilds_at_startup": MEMBER_CACHE != 'lazy',
+               "activity": discord.Game(name="Chat Leaderboard | /help")}
+
+# Sharding: leave SHARD_COUNT unset for a single gateway connection, set it to 'auto'
+# to use Discord's recommended count, or to a number. cluster.py runs several processes
+# that each take a range of SHARD_IDS out of the same SHARD_COUNT.
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')
+SHARD_IDS = [int(s) for s in os.getenv('SHARD_IDS', '').split(',') if s.strip()]
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 1))
+
+if SHARD_COUNT == 'auto':
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents, **bot_options)
+elif SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents, shard_count=int(SHARD_COUNT),
+                                  shard_ids=SHARD_IDS or None, **bot_options)
+else:
+    bot = commands.Bot(command_prefix='/', intents=intents, **bot_options)
+
+# Per-guild message counts are stored in files like 'message_counts_123456789.json',
+# or in a single SQLite database when STORAGE_BACKEND=sqlite
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'strack.db')
+# Each cluster process keeps its own log and (JSON backend) timer journal
+BOT_LOGS_FILE = os.getenv('BOT_LOGS_FILE') or ('bot_logs.jsonl' if CLUSTER_COUNT == 1 else f'bot_logs.cluster{CLUSTER_ID}.jsonl')
+TIMERS_FILE = 'timers.jsonl' if CLUSTER_COUNT == 1 else f'timers.cluster{CLUSTER_ID}.jsonl'
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', 2))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_HOURS = float(os.getenv('LOG_ROTATE_HOURS', 0))
+LOG_COMPRESS = os.getenv('LOG_COMPRESS', '1') == '1'
+# Legacy global exclusion; applies to guilds that haven't set up their own /config yet
 EXCLUDED_CHANNEL_ID = int(os.getenv('EXCLUDED_CHANNEL_ID', 0))
 
+# Write-back cache settings for per-guild message counts
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 2_000_000))
+CACHE_FLUSH_INTERVAL = float(os.getenv('CACHE_FLUSH_INTERVAL', 30))
+CACHE_DIRTY_THRESHOLD = int(os.getenv('CACHE_DIRTY_THRESHOLD', 500))
+TIMER_MAX_MINUTES = int(os.getenv('TIMER_MAX_MINUTES', 43200))
+TIMER_MAX_PER_USER = int(os.getenv('TIMER_MAX_PER_USER', 5))
+TIMER_MAX_PER_GUILD = int(os.getenv('TIMER_MAX_PER_GUILD', 500))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', 5000))
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', 8))
+DISPATCH_QUEUE_LIMIT = int(os.getenv('DISPATCH_QUEUE_LIMIT', 50))
+MENTION_REPLY_COOLDOWN = float(os.getenv('MENTION_REPLY_COOLDOWN', 10))
+ANALYTICS_CACHE_SIZE = int(os.getenv('ANALYTICS_CACHE_SIZE', 500))
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+EXPORT_PART_SIZE = int(os.getenv('EXPORT_PART_SIZE', PART_SIZE))
+# Activity older than the longest leaderboard window is folded into daily rollups,
+# which are kept for ROLLUP_RETENTION_DAYS (0 = forever)
+COMPACTION_INTERVAL = float(os.getenv('COMPACTION_INTERVAL', 3600))
+ROLLUP_RETENTION_DAYS = int(os.getenv('ROLLUP_RETENTION_DAYS', 365))
+USERS_PER_PAGE = 10
+# Hash of the last command tree synced to Discord; sync is skipped while it matches
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', 'command_tree.json')
+
 PING_RESPONSES = [
     "⚡ Beep boop! I’m awake and ready, what’s up?",
     "👋 You called? I have risen from my digital nap!",
@@ -35,73 +111,113 @@ PING_RESPONSES = [
 ]
 
 # ---------------------- HELPER FUNCTIONS ----------------------
-def get_message_counts_file(guild_id):
-    """Returns the file path for a specific guild's message counts."""
-    return f'message_counts_{guild_id}.json'
-
-def load_message_counts(guild_id):
-    """Loads message counts from a file specific to a guild."""
-    file_path = get_message_counts_file(guild_id)
-    default_data = {"counts": {}, "timestamps": {}, "last_reset": int(time.time())}
-    if not os.path.exists(file_path):
-        save_message_counts(guild_id, default_data)
-        return default_data
-    try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            data.setdefault("counts", {})
-            data.setdefault("timestamps", {})
-            data.setdefault("last_reset", int(time.time()))
-            # Normalize timestamps to lists
-            for uid, ts in list(data["timestamps"].items()):
-                if not isinstance(ts, list):
-                    data["timestamps"][uid] = [float(ts)] if ts else []
-            return data
-    except Exception as e:
-        logger.error(f"Error loading {file_path}: {e}")
-        save_message_counts(guild_id, default_data)
-        return default_data
+event_log = EventLog(BOT_LOGS_FILE, max_bytes=LOG_MAX_BYTES,
+                     rotate_seconds=LOG_ROTATE_HOURS * 3600, compress=LOG_COMPRESS)
+
+def save_bot_log(event, details):
+    """Queues an event for the bot log; the entry is written by the next log flush."""
+    event_log.append(event, details)
 
-def save_message_counts(guild_id, data):
-    """Saves message counts to a file specific to a guild."""
-    file_path = get_message_counts_file(guild_id)
+async def flush_bot_log():
     try:
-        temp_file = file_path + '.tmp'
-        with open(temp_file, 'w') as f:
-            json.dump(data, f, indent=4)
-        os.replace(temp_file, file_path)
+        await asyncio.to_thread(event_log.flush)
     except Exception as e:
-        logger.error(f"Error saving message counts for guild {guild_id}: {e}")
+        logger.error(f"Error saving bot log: {e}")
+
+@tasks.loop(seconds=LOG_FLUSH_INTERVAL)
+async def flush_bot_log_task():
+    await flush_bot_log()
 
-def load_bot_logs():
-    default_data = {"logs": []}
-    if not os.path.exists(BOT_LOGS_FILE):
-        save_bot_log("init", f"Created {BOT_LOGS_FILE}")
-        return default_data
+# ---------------------- METRICS ----------------------
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram("strack_handler_seconds", "Time spent in event handlers and slash commands", ["handler"])
+STORAGE_LATENCY = metrics.histogram("strack_storage_seconds", "Time spent loading, saving and flushing guild data", ["op"])
+MESSAGES_PROCESSED = metrics.counter("strack_messages_total", "Messages counted", ["guild"])
+SHARD_MESSAGES = metrics.counter("strack_shard_messages_total", "Messages counted per shard", ["shard"])
+SHARD_DISCONNECTS = metrics.counter("strack_shard_disconnects_total", "Gateway disconnects per shard", ["shard"])
+profiler = Profiler()
+
+storage = create_storage(STORAGE_BACKEND, path=SQLITE_PATH, timers_file=TIMERS_FILE)
+guild_cache = GuildCache(timed(STORAGE_LATENCY, "load")(storage.load_guild), timed(STORAGE_LATENCY, "save")(storage.save_guild),
+                         max_entries=CACHE_MAX_ENTRIES, dirty_threshold=CACHE_DIRTY_THRESHOLD)
+
+async def flush_message_counts():
     try:
-        with open(BOT_LOGS_FILE, 'r') as f:
-            data = json.load(f)
-            data.setdefault("logs", [])
-            return data
+        with STORAGE_LATENCY.timer("flush"):
+            await guild_cache.flush()
     except Exception as e:
-        logger.error(f"Error loading {BOT_LOGS_FILE}: {e}")
-        return default_data
+        logger.error(f"Error flushing message counts: {e}")
 
-def save_bot_log(event, details):
+page_cache = PageCache(PAGE_CACHE_SIZE)
+guild_configs = GuildConfigStore(storage, GuildConfig(excluded_channels={EXCLUDED_CHANNEL_ID} if EXCLUDED_CHANNEL_ID else ()))
+
+metrics.counter_callback("strack_cache_hits_total", "Cache hits",
+                         lambda: {("guild_data",): guild_cache.hits, ("pages",): page_cache.hits, ("member_names",): member_names.hits}, ["cache"])
+metrics.counter_callback("strack_cache_misses_total", "Cache misses",
+                         lambda: {("guild_data",): guild_cache.misses, ("pages",): page_cache.misses, ("member_names",): member_names.misses}, ["cache"])
+metrics.gauge_callback("strack_cached_guilds", "Guilds resident in the message count cache", lambda: len(guild_cache))
+metrics.counter_callback("strack_file_bytes_written_total", "Bytes written to data and log files",
+                         lambda: {("bot_log",): event_log.bytes_written, ("message_counts",): getattr(storage, "bytes_written", 0)}, ["file"])
+DISPATCH_WAIT = metrics.histogram("strack_dispatch_wait_seconds", "Time outbound messages spent queued", ["priority"])
+# Bot-initiated channel messages (mention replies, timer notifications) are sent from per-channel queues.
+dispatcher = Dispatcher(DISPATCH_CONCURRENCY, DISPATCH_QUEUE_LIMIT, MENTION_REPLY_COOLDOWN, wait_histogram=DISPATCH_WAIT)
+metrics.gauge_callback("strack_dispatch_queue_depth", "Outbound messages waiting to be sent",
+                       lambda: {(name,): n for name, n in dispatcher.depth().items()}, ["priority"])
+metrics.gauge_callback("strack_dispatch_busy_channels", "Channels with outbound messages being sent", lambda: dispatcher.busy_channels)
+metrics.counter_callback("strack_dispatch_messages_total", "Outbound messages by outcome (sent, failed, coalesced, overflow)",
+                         lambda: dict(dispatcher.outcomes), ["priority", "outcome"])
+metrics.gauge_callback("strack_gateway_latency_seconds", "Discord gateway heartbeat latency", lambda: 0 if math.isnan(bot.latency) else bot.latency)
+
+# ---------------------- SHARDS ----------------------
+def owns_guild(guild_id):
+    """Whether this process runs the shard for a guild (DMs belong to cluster 0)."""
+    if not bot.shard_count or not SHARD_IDS:
+        return True
+    if guild_id is None:
+        return CLUSTER_ID == 0
+    return (int(guild_id) >> 22) % bot.shard_count in SHARD_IDS
+
+def shard_health():
+    """Returns {shard_id: (up, latency_seconds, guilds)} for the shards run by this process."""
+    guilds = {}
+    for guild in bot.guilds:
+        guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+    if isinstance(bot, commands.AutoShardedBot):
+        shards = {shard_id: (not info.is_closed(), info.latency) for shard_id, info in bot.shards.items()}
+    else:
+        shards = {0: (bot.is_ready() and not bot.is_closed(), bot.latency)}
+    return {shard_id: (up, 0 if math.isnan(latency) else latency, guilds.get(shard_id, 0))
+            for shard_id, (up, latency) in shards.items()}
+
+metrics.gauge_callback("strack_shard_up", "Whether each shard's gateway connection is open",
+                       lambda: {(str(s),): int(h[0]) for s, h in shard_health().items()}, ["shard"])
+metrics.gauge_callback("strack_shard_latency_seconds", "Gateway heartbeat latency per shard",
+                       lambda: {(str(s),): h[1] for s, h in shard_health().items()}, ["shard"])
+metrics.gauge_callback("strack_shard_guilds", "Guilds per shard",
+                       lambda: {(str(s),): h[2] for s, h in shard_health().items()}, ["shard"])
+
+@tasks.loop(seconds=CACHE_FLUSH_INTERVAL)
+async def flush_message_counts_task():
+    await flush_message_counts()
+
+compactor = Compactor(guild_cache, storage, rollup_retention_days=ROLLUP_RETENTION_DAYS, owns=owns_guild)
+metrics.counter_callback("strack_compaction_reclaimed_total", "Activity data folded into rollups or expired",
+                         lambda: {(kind,): n for kind, n in compactor.totals.items()}, ["kind"])
+
+@tasks.loop(seconds=COMPACTION_INTERVAL)
+async def compaction_task():
     try:
-        data = load_bot_logs()
-        log_entry = {
-            "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
-            "event": event,
-            "details": details
-        }
-        data["logs"].append(log_entry)
-        temp_file = BOT_LOGS_FILE + '.tmp'
-        with open(temp_file, 'w') as f:
-            json.dump(data, f, indent=4)
-        os.replace(temp_file, BOT_LOGS_FILE)
+        with STORAGE_LATENCY.timer("compact"):
+            reclaimed = await compactor.run_once()
     except Exception as e:
-        logger.error(f"Error saving bot log: {e}")
+        logger.error(f"Error compacting activity data: {e}")
+        return
+    summary = (f"{reclaimed['messages']} message(s) in {reclaimed['buckets']} hourly bucket(s) rolled up, "
+               f"{reclaimed['histograms']} idle histogram(s) freed, {reclaimed['events']} event row(s) folded, "
+               f"{reclaimed['rollup_days'] + reclaimed['rollup_rows']} expired rollup(s) dropped")
+    logger.info(f"Compaction: {summary}")
+    if any(reclaimed.values()):
+        save_bot_log("compaction", summary)
 
 # Flexible role resolver
 def resolve_role_from_input(guild: discord.Guild, raw: str):
@@ -117,56 +233,194 @@ def resolve_role_from_input(guild: discord.Guild, raw: str):
         try: return guild.get_role(int(s))
         except: pass
     if s.startswith("@"): s = s[1:].strip()
-    role = discord.utils.find(lambda r: r.name.lower() == s.lower(), guild.roles)
-    if role: return role
-    matches = [r for r in guild.roles if s.lower() in r.name.lower()]
-    if len(matches) == 1: return matches[0]
-    elif len(matches) > 1:
-        try: return max(matches, key=lambda r: r.position)
-        except: return matches[0]
-    return None
+    return get_role_index(guild).find(s)
+
+# Per-guild role membership indexes, built on first use and kept current by events
+role_indexes = {}
+
+member_names = MemberNameCache(ttl=MEMBER_NAME_TTL)
+
+async def ensure_chunked(guild):
+    """Downloads a guild's member list if it wasn't loaded at startup (MEMBER_CACHE=lazy).
+    Only role leaderboards need it, since role membership lives on the members."""
+    if not guild.chunked:
+        await guild.chunk()
+        # An index built before the members arrived is incomplete.
+        role_indexes.pop(guild.id, None)
+
+def get_role_index(guild):
+    index = role_indexes.get(guild.id)
+    if index is None:
+        index = role_indexes[guild.id] = RoleIndex(guild)
+    return index
 
 # ---------------------- EVENTS ----------------------
 @bot.event
-async def on_ready():
-    logger.info(f'Logged in as {bot.user} at {datetime.now(timezone.utc)}')
-    save_bot_log("online", f"Bot logged in as {bot.user}")
-    await bot.change_presence(activity=discord.Game(name="Chat Leaderboard | /help"))
+async def setup_hook():
+    storage.start()
+    guild_configs.load()
+    bot.add_dynamic_items(LeaderboardButton)
+    flush_message_counts_task.start()
+    flush_bot_log_task.start()
+    compaction_task.start()
+    # SQLite timers are shared by every cluster; each fires the ones for its own shards.
+    timer_scheduler.load(owns_guild if STORAGE_BACKEND == 'sqlite' else None)
+    timer_scheduler.start()
+    if METRICS_PORT:
+        try:
+            await start_http_server(metrics, '127.0.0.1', METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on port {METRICS_PORT}: {e}")
+
+def command_tree_hash():
+    """SHA-256 of the command tree as it is sent to Discord (names, descriptions, options)."""
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def load_synced_hash():
+    try:
+        with open(COMMAND_HASH_FILE, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # A different application (e.g. a test bot using the same folder) needs its own sync.
+    return saved.get("hash") if saved.get("application_id") == bot.application_id else None
+
+def save_synced_hash(tree_hash):
+    temp_file = COMMAND_HASH_FILE + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump({"application_id": bot.application_id, "hash": tree_hash, "synced": int(time.time())}, f)
+    os.replace(temp_file, COMMAND_HASH_FILE)
+
+async def sync_commands():
+    """Syncs the global command tree, unless it is unchanged since the last sync."""
+    tree_hash = command_tree_hash()
+    if tree_hash == load_synced_hash():
+        logger.info("Slash commands unchanged since the last sync; skipping sync.")
+        return
     try:
         synced = await bot.tree.sync()
+        save_synced_hash(tree_hash)
         logger.info(f"Synced {len(synced)} slash command(s).")
     except Exception as e:
         logger.error(f"Failed to sync commands: {e}")
 
+startup_done = False
+
+@bot.event
+async def on_ready():
+    # on_ready fires again whenever the gateway has to start a new session; only the
+    # first one does startup work.
+    global startup_done
+    if startup_done:
+        logger.info(f"Reconnected as {bot.user} with a new session")
+        save_bot_log("online", f"Bot reconnected as {bot.user}")
+        return
+    startup_done = True
+    logger.info(f'Logged in as {bot.user} at {datetime.now(timezone.utc)}')
+    save_bot_log("online", f"Bot logged in as {bot.user}")
+    # Commands are global, so one cluster syncing them is enough.
+    if CLUSTER_ID == 0:
+        await sync_commands()
+
+@bot.event
+async def on_resumed():
+    # The session was resumed and missed events replayed: nothing to redo.
+    logger.info("Gateway session resumed")
+
 @bot.event
 async def on_disconnect():
     save_bot_log("offline", "Bot went offline")
     logger.info("Bot disconnected")
+    await flush_message_counts()
+    await flush_bot_log()
+
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f"Shard {shard_id} ready")
+    save_bot_log("shard", f"Shard {shard_id} ready")
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    SHARD_DISCONNECTS.inc(str(shard_id))
+    logger.info(f"Shard {shard_id} disconnected")
+    save_bot_log("shard", f"Shard {shard_id} disconnected")
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    logger.info(f"Shard {shard_id} resumed")
+
+@bot.event
+async def on_member_join(member):
+    if member.guild.id in role_indexes:
+        role_indexes[member.guild.id].add_member(member)
+
+@bot.event
+async def on_member_remove(member):
+    member_names.forget(member.guild.id, member.id)
+    if member.guild.id in role_indexes:
+        role_indexes[member.guild.id].remove_member(member)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        member_names.forget(after.guild.id, after.id)
+    if after.guild.id in role_indexes and before.roles != after.roles:
+        role_indexes[after.guild.id].update_member(before, after)
+
+@bot.event
+async def on_guild_role_create(role):
+    if role.guild.id in role_indexes:
+        role_indexes[role.guild.id].add_role(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if after.guild.id in role_indexes:
+        role_indexes[after.guild.id].update_role(before, after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    if role.guild.id in role_indexes:
+        role_indexes[role.guild.id].remove_role(role)
+    if str(role.guild.id) in guild_cache:
+        get_rankings(guild_cache.get(str(role.guild.id))).forget_role(role.id)
 
 @bot.event
+async def on_guild_remove(guild):
+    role_indexes.pop(guild.id, None)
+
+@bot.event
+@timed(HANDLER_LATENCY, "on_message")
 async def on_message(message):
-    if message.author.bot or not message.guild or message.channel.id == EXCLUDED_CHANNEL_ID:
+    if message.author.bot or not message.guild or not guild_configs.get(message.guild.id).counts(message):
         return
 
     guild_id = str(message.guild.id)
-    data = load_message_counts(guild_id)
-    message_counts = data.get("counts", {})
-    message_timestamps = data.get("timestamps", {})
-    last_reset = data.get("last_reset", int(time.time()))
+    data = await guild_cache.load(guild_id)
+    message_counts = data["counts"]
+    message_activity = data["activity"]
 
     if bot.user.mentioned_in(message):
-        await message.channel.send(random.choice(PING_RESPONSES))
+        # Queued, and at most one reply per channel per cooldown during mention storms.
+        dispatcher.send(message.channel, random.choice(PING_RESPONSES), priority=REPLY, key="mention")
     
     user_id = str(message.author.id)
     message_counts[user_id] = message_counts.get(user_id, 0) + 1
-    message_timestamps[user_id] = message_timestamps.get(user_id, [])
-    message_timestamps[user_id].append(message.created_at.timestamp())
+    sent_at = message.created_at.timestamp()
+    get_rankings(data).record(user_id, ts=sent_at)
+    MESSAGES_PROCESSED.inc(guild_id)
+    SHARD_MESSAGES.inc(str(message.guild.shard_id))
+    hist = message_activity.get(user_id)
+    is_new_user = hist is None
+    if is_new_user:
+        hist = message_activity[user_id] = ActivityHistogram()
+    hist.add(sent_at)
     
-    save_message_counts(guild_id, {
-        "counts": message_counts,
-        "timestamps": message_timestamps,
-        "last_reset": last_reset
-    })
+    if storage.persists_increments:
+        storage.record_message(guild_id, user_id, sent_at)
+        guild_cache.add_weight(guild_id, 2 if is_new_user else 0)
+    elif guild_cache.mark_dirty(guild_id, weight_delta=2 if is_new_user else 0):
+        asyncio.create_task(flush_message_counts())
     
     await bot.process_commands(message)
 
@@ -214,9 +468,167 @@ async def vote(interaction: discord.Interaction):
     logger.info(f"Vote command used by {interaction.user.name} (ID: {interaction.user.id})")
     save_bot_log("vote_command", f"Vote command used by {interaction.user.name} in channel {interaction.channel.name}")
 
+# ---------------------- LEADERBOARD PAGES ----------------------
+# A leaderboard "scope" is a timeframe key from TIMEFRAMES or "role-<role_id>".
+def get_leaderboard_index(guild, scope):
+    """Returns (role or None, RankingIndex) for a scope, or (None, None) if the role is gone."""
+    rankings = get_rankings(guild_cache.get(str(guild.id)))
+    if scope.startswith("role-"):
+        role = guild.get_role(int(scope[5:]))
+        if role is None:
+            return None, None
+        roles = get_role_index(guild)
+        return role, rankings.get_role(role.id, roles.members.get(role.id, set()), roles.membership_version(role.id))
+    return None, rankings.get(scope)
+
+def member_mention(guild, user_id):
+    """Mention for a leaderboard row, or a plain fallback for users who have left."""
+    if guild.get_member(user_id) is not None:
+        return f"<@{user_id}>"
+    if MEMBER_CACHE == 'lazy':
+        cached = member_names.get(guild.id, user_id)
+        # If the lookup failed, a mention still renders without knowing the member.
+        if cached is None or cached[0] is not None:
+            return f"<@{user_id}>"
+    return f"Unknown ({user_id})"
+
+def page_user_ids(guild, scope, page_num):
+    """User IDs shown on one leaderboard page (clamped to the last page)."""
+    _, index = get_leaderboard_index(guild, scope)
+    if index is None or not len(index):
+        return []
+    page_num = max(0, min(page_num, (len(index) - 1) // USERS_PER_PAGE))
+    return [int(uid) for uid, _ in index.page(page_num * USERS_PER_PAGE, (page_num + 1) * USERS_PER_PAGE)]
+
+def leaderboard_page_needs_fetch(guild, scope, page_num):
+    """Whether prepare_leaderboard_page would have to wait on storage or Discord for a page."""
+    if str(guild.id) not in guild_cache:
+        return True
+    if MEMBER_CACHE != 'lazy':
+        return False
+    if scope.startswith("role-") and not guild.chunked:
+        return True
+    return bool(missing_members(guild, page_user_ids(guild, scope, page_num), member_names))
+
+async def prepare_leaderboard_page(guild, scope, page_num):
+    """Loads what a page needs before it is rendered: the guild's counts and, in
+    lazy member mode, the member list for role scopes and the names on the page."""
+    await guild_cache.load(str(guild.id))
+    if MEMBER_CACHE != 'lazy':
+        return
+    if scope.startswith("role-"):
+        await ensure_chunked(guild)
+    try:
+        await resolve_members(guild, page_user_ids(guild, scope, page_num), member_names)
+    except Exception as e:
+        logger.error(f"Error resolving leaderboard members for guild {guild.id}: {e}")
+
+def render_leaderboard_page(guild, scope, page_num):
+    """Builds the embed for one leaderboard page. Returns (embed, page_num, total_pages),
+    or None if nobody in the scope has messages. Page text is cached per index version."""
+    role, index = get_leaderboard_index(guild, scope)
+    if index is None or not len(index):
+        return None
+    total_pages = (len(index) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
+    page_num = max(0, min(page_num, total_pages - 1))
+
+    key = (guild.id, scope, index.version, page_num)
+    table = page_cache.get(key)
+    if table is None:
+        table = ""
+        for i, (user_id, count) in enumerate(index.page(page_num * USERS_PER_PAGE, (page_num + 1) * USERS_PER_PAGE)):
+            name = member_mention(guild, int(user_id))
+            table += f"{i + page_num * USERS_PER_PAGE + 1}. {name} - {count}\n"
+        page_cache.put(key, table)
+
+    if role is not None:
+        title = f"🏆 {role.name} Message Leaderboard"
+    else:
+        title = f"🏆 {guild.name} Leaderboard ({scope.capitalize() if scope != 'all' else 'All Time'})"
+    embed = discord.Embed(title=title, description=table, timestamp=datetime.utcnow())
+    embed.set_thumbnail(url=guild.icon.url if guild.icon else bot.user.avatar.url if bot.user.avatar else bot.user.default_avatar.url)
+    embed.set_footer(text=f"Page {page_num + 1}/{total_pages} | Total Messages: {index.total}")
+    return embed, page_num, total_pages
+
+async def show_leaderboard_page(interaction, owner_id, scope, page_num):
+    """Answers a button or modal interaction by editing the leaderboard in place,
+    with a single response. Only if the page needs members or counts fetched first,
+    which can outlast the 3 second deadline, is the interaction deferred instead."""
+    deferred = leaderboard_page_needs_fetch(interaction.guild, scope, page_num)
+    if deferred:
+        await interaction.response.defer()
+        await prepare_leaderboard_page(interaction.guild, scope, page_num)
+    respond = interaction.edit_original_response if deferred else interaction.response.edit_message
+    rendered = render_leaderboard_page(interaction.guild, scope, page_num)
+    if rendered is None:
+        await respond(content="This leaderboard has no messages anymore.", embed=None, view=None)
+        return
+    embed, page_num, total_pages = rendered
+    await respond(embed=embed, view=leaderboard_view(owner_id, scope, page_num, total_pages))
+
+class LeaderboardButton(discord.ui.DynamicItem[discord.ui.Button],
+                        template=r'lb:(?P<owner>\d+):(?P<scope>[\w-]+):(?P<page>\d+):(?P<action>prev|next|jump)'):
+    """Stateless pagination button. Everything it needs is in its custom_id, so
+    buttons keep working on old messages and across restarts."""
+
+    def __init__(self, owner_id, scope, page_num, action, label=None, disabled=False):
+        self.owner_id = owner_id
+        self.scope = scope
+        self.page_num = page_num
+        self.action = action
+        super().__init__(discord.ui.Button(
+            label=label,
+            emoji={"prev": "⬅️", "next": "➡️", "jump": None}[action],
+            style=discord.ButtonStyle.secondary,
+            disabled=disabled,
+            custom_id=f"lb:{owner_id}:{scope}:{page_num}:{action}"
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["owner"]), match["scope"], int(match["page"]), match["action"])
+
+    async def callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("Only the person who opened this leaderboard can flip its pages.", ephemeral=True)
+            return
+        try:
+            if self.action == "jump":
+                await interaction.response.send_modal(JumpToPageModal(self.owner_id, self.scope))
+                return
+            target = self.page_num + (1 if self.action == "next" else -1)
+            await show_leaderboard_page(interaction, self.owner_id, self.scope, target)
+        except Exception as e:
+            logger.error(f"Error in leaderboard pagination: {e}")
+
+class JumpToPageModal(discord.ui.Modal, title="Jump to page"):
+    page = discord.ui.TextInput(label="Page number", max_length=6)
+
+    def __init__(self, owner_id, scope):
+        super().__init__()
+        self.owner_id = owner_id
+        self.scope = scope
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            target = int(self.page.value) - 1
+        except ValueError:
+            await interaction.response.send_message("Please enter a page number.", ephemeral=True)
+            return
+        await show_leaderboard_page(interaction, self.owner_id, self.scope, target)
+
+def leaderboard_view(owner_id, scope, page_num, total_pages):
+    view = discord.ui.View(timeout=None)
+    if total_pages > 1:
+        view.add_item(LeaderboardButton(owner_id, scope, page_num, "prev", disabled=page_num == 0))
+        view.add_item(LeaderboardButton(owner_id, scope, page_num, "jump", label=f"{page_num + 1}/{total_pages}"))
+        view.add_item(LeaderboardButton(owner_id, scope, page_num, "next", disabled=page_num >= total_pages - 1))
+    return view
+
 # ---------------------- /leaderboard ----------------------
 @bot.tree.command(name="leaderboard", description="Display the leaderboard for a specific timeframe")
 @discord.app_commands.describe(timeframe="Timeframe to filter the leaderboard (1h, 1d, 24h, 7d, 14d, all); defaults to 'all'")
+@timed(HANDLER_LATENCY, "/leaderboard")
 async def leaderboard(interaction: discord.Interaction, timeframe: str = "all"):
     await interaction.response.defer()
     try:
@@ -225,168 +637,136 @@ async def leaderboard(interaction: discord.Interaction, timeframe: str = "all"):
             await interaction.followup.send("Guild not available.", ephemeral=True)
             return
 
-        data = load_message_counts(str(guild.id))
-        message_counts = data.get("counts", {})
-        message_timestamps = data.get("timestamps", {})
-
-        current_time = time.time()
-        timeframe_options = {"1h": 3600, "1d": 86400, "24h": 86400, "7d": 604800, "14d": 1209600, "all": 0}
-
-        if timeframe not in timeframe_options:
+        if timeframe not in TIMEFRAMES:
             await interaction.followup.send("Invalid timeframe! Use 1h, 1d, 24h, 7d, 14d, or all.", ephemeral=True)
             return
 
-        leaderboard_list = []
-        for member in guild.members:
-            user_id = str(member.id)
-            if timeframe == "all":
-                count = message_counts.get(user_id, 0)
-            else:
-                threshold = current_time - timeframe_options[timeframe]
-                count = sum(1 for t in message_timestamps.get(user_id, []) if t >= threshold)
-            leaderboard_list.append((member.display_name, count, user_id))
-
-        if not leaderboard_list or all(count == 0 for _, count, _ in leaderboard_list):
+        await prepare_leaderboard_page(guild, timeframe, 0)
+        rendered = render_leaderboard_page(guild, timeframe, 0)
+        if rendered is None:
             await interaction.followup.send("No messages found for this timeframe.", ephemeral=True)
             return
 
-        leaderboard_list.sort(key=lambda x: (-x[1], x[0]))
-        total_messages = sum(count for _, count, _ in leaderboard_list)
-        users_per_page = 10
-        pages = [leaderboard_list[i:i + users_per_page] for i in range(0, len(leaderboard_list), users_per_page)]
-        total_pages = len(pages)
-        current_page = 0
-
-        def generate_embed(page_num):
-            page = pages[page_num]
-            table = ""
-            for i, (_, count, user_id) in enumerate(page):
-                member = guild.get_member(int(user_id))
-                name = member.mention if member else f"Unknown ({user_id})"
-                table += f"{i + page_num * users_per_page + 1}. {name} - {count}\n"
-
-            embed = discord.Embed(
-                title=f"🏆 {guild.name} Leaderboard ({timeframe.capitalize() if timeframe != 'all' else 'All Time'})",
-                description=table,
-                timestamp=datetime.utcnow()
-            )
-            embed.set_thumbnail(url=guild.icon.url if guild.icon else bot.user.avatar.url if bot.user.avatar else bot.user.default_avatar.url)
-            embed.set_footer(text=f"Page {page_num + 1}/{total_pages} | Total Messages: {total_messages}")
-            return embed
-
-        message = await interaction.followup.send(embed=generate_embed(current_page))
-
-        if total_pages > 1:
-            await message.add_reaction("⬅️")
-            await message.add_reaction("➡️")
-
-            def check(reaction, user):
-                return user == interaction.user and str(reaction.emoji) in ["⬅️", "➡️"] and reaction.message.id == message.id
-
-            while True:
-                try:
-                    reaction, user = await bot.wait_for("reaction_add", timeout=60.0, check=check)
-                    if str(reaction.emoji) == "➡️" and current_page < total_pages - 1:
-                        current_page += 1
-                    elif str(reaction.emoji) == "⬅️" and current_page > 0:
-                        current_page -= 1
-                    await message.edit(embed=generate_embed(current_page))
-                    await message.remove_reaction(reaction, user)
-                except asyncio.TimeoutError:
-                    await message.clear_reactions()
-                    break
-                except Exception as e:
-                    logger.error(f"Error in leaderboard pagination: {e}")
-                    break
+        embed, page_num, total_pages = rendered
+        await interaction.followup.send(embed=embed, view=leaderboard_view(interaction.user.id, timeframe, page_num, total_pages))
     except Exception as e:
         logger.error(f"Error in /leaderboard: {e}")
 
+# ---------------------- /rank ----------------------
+@bot.tree.command(name="rank", description="Show a member's leaderboard position and message count")
+@discord.app_commands.describe(user="The member to look up; defaults to you",
+                               timeframe="Timeframe to rank by (1h, 1d, 24h, 7d, 14d, all); defaults to 'all'")
+@timed(HANDLER_LATENCY, "/rank")
+async def rank(interaction: discord.Interaction, user: discord.Member = None, timeframe: str = "all"):
+    guild = interaction.guild
+    if not guild:
+        await interaction.response.send_message("Guild not available.", ephemeral=True)
+        return
+    if timeframe not in TIMEFRAMES:
+        await interaction.response.send_message("Invalid timeframe! Use 1h, 1d, 24h, 7d, 14d, or all.", ephemeral=True)
+        return
+
+    target = user or interaction.user
+    index = get_rankings(await guild_cache.load(str(guild.id))).get(timeframe)
+    position = index.rank(str(target.id))
+    label = timeframe if timeframe != "all" else "all time"
+    if position is None:
+        await interaction.response.send_message(f"{target.mention} has no counted messages ({label}).", ephemeral=True)
+        return
+    await interaction.response.send_message(
+        f"{target.mention} is **#{position}** of {len(index)} with **{index.count(str(target.id))}** message(s) ({label}).",
+        ephemeral=True
+    )
+
 # ---------------------- /rolecount ----------------------
 @bot.tree.command(name="rolecount", description="Display the leaderboard for a specified role")
 @discord.app_commands.describe(role_name="The name of the role to filter the leaderboard (e.g., 'Admin')")
+@timed(HANDLER_LATENCY, "/rolecount")
 async def rolecount(interaction: discord.Interaction, role_name: str):
     await interaction.response.defer()
     try:
         guild = interaction.guild
+        if MEMBER_CACHE == 'lazy':
+            await ensure_chunked(guild)
         target_role = resolve_role_from_input(guild, role_name)
         if not target_role:
             await interaction.followup.send(f"No role matching '{role_name}' found.", ephemeral=True)
             return
 
-        data = load_message_counts(str(guild.id))
-        message_counts = data.get("counts", {})
-
-        leaderboard_list = [(m.display_name, message_counts.get(str(m.id), 0), str(m.id)) for m in guild.members if target_role in m.roles]
-
-        if not leaderboard_list or all(count == 0 for _, count, _ in leaderboard_list):
+        scope = f"role-{target_role.id}"
+        await prepare_leaderboard_page(guild, scope, 0)
+        rendered = render_leaderboard_page(guild, scope, 0)
+        if rendered is None:
             await interaction.followup.send(f"No messages found for members with the '{target_role.name}' role.", ephemeral=True)
             return
 
-        leaderboard_list.sort(key=lambda x: (-x[1], x[0]))
-        total_messages = sum(count for _, count, _ in leaderboard_list)
-        users_per_page = 10
-        pages = [leaderboard_list[i:i + users_per_page] for i in range(0, len(leaderboard_list), users_per_page)]
-        total_pages = len(pages)
-        current_page = 0
-
-        def generate_embed(page_num):
-            page = pages[page_num]
-            table = ""
-            for i, (_, count, user_id) in enumerate(page):
-                member = guild.get_member(int(user_id))
-                name = member.mention if member else f"Unknown ({user_id})"
-                table += f"{i + page_num * users_per_page + 1}. {name} - {count}\n"
-
-            embed = discord.Embed(
-                title=f"🏆 {target_role.name} Message Leaderboard",
-                description=table,
-                timestamp=datetime.utcnow()
-            )
-            embed.set_thumbnail(url=guild.icon.url if guild.icon else bot.user.avatar.url if bot.user.avatar else bot.user.default_avatar.url)
-            embed.set_footer(text=f"Page {page_num + 1}/{total_pages} | Total Messages: {total_messages}")
-            return embed
-
-        message = await interaction.followup.send(embed=generate_embed(current_page))
-
-        if total_pages > 1:
-            await message.add_reaction("⬅️")
-            await message.add_reaction("➡️")
-
-            def check(reaction, user):
-                return user == interaction.user and str(reaction.emoji) in ["⬅️", "➡️"] and reaction.message.id == message.id
-
-            while True:
-                try:
-                    reaction, user = await bot.wait_for("reaction_add", timeout=60.0, check=check)
-                    if str(reaction.emoji) == "➡️" and current_page < total_pages - 1:
-                        current_page += 1
-                    elif str(reaction.emoji) == "⬅️" and current_page > 0:
-                        current_page -= 1
-                    await message.edit(embed=generate_embed(current_page))
-                    await message.remove_reaction(reaction, user)
-                except asyncio.TimeoutError:
-                    await message.clear_reactions()
-                    break
-                except Exception as e:
-                    logger.error(f"Error in rolecount pagination: {e}")
-                    break
+        embed, page_num, total_pages = rendered
+        await interaction.followup.send(embed=embed, view=leaderboard_view(interaction.user.id, scope, page_num, total_pages))
     except Exception as e:
         logger.error(f"Error in /rolecount: {e}")
 
 # Slash command: /timer
+async def fire_timer(timer, late_by):
+    """Announces a finished timer in the channel it was set in (or by DM if that's gone)."""
+    await bot.wait_until_ready()
+    mention = f"<@{timer['user_id']}>"
+    text = f"Timer finished for {mention}!"
+    if late_by > 60:
+        text += f" (Sorry, I was offline when it ended — this is {round(late_by / 60)} minute(s) late.)"
+    channel = bot.get_channel(timer["channel_id"])
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(timer["channel_id"])
+        except discord.HTTPException:
+            channel = await bot.fetch_user(timer["user_id"])
+    # Waits for the send so a failure raises and the scheduler retries the timer.
+    await dispatcher.deliver(channel, text, priority=NOTIFY)
+    logger.info(f"Timer {timer['id']} expired for user {timer['user_id']}")
+    save_bot_log("timer", f"Timer {timer['id']} expired for user ID {timer['user_id']}")
+
+timer_scheduler = TimerScheduler(storage, fire_timer, max_per_user=TIMER_MAX_PER_USER, max_per_guild=TIMER_MAX_PER_GUILD,
+                                 id_offset=CLUSTER_ID, id_step=CLUSTER_COUNT)
+metrics.gauge_callback("strack_pending_timers", "Timers waiting to fire", lambda: len(timer_scheduler))
+
 @bot.tree.command(name="timer", description="Set a countdown timer in minutes")
 @discord.app_commands.describe(minutes="Number of minutes for the timer")
 async def timer(interaction: discord.Interaction, minutes: int):
-    await interaction.response.send_message(f"Timer set for {minutes} minute(s). I’ll notify you when it’s done!", ephemeral=True)
+    if minutes < 1 or minutes > TIMER_MAX_MINUTES:
+        await interaction.response.send_message(f"Timers can run from 1 to {TIMER_MAX_MINUTES} minutes.", ephemeral=True)
+        return
+    guild_id = str(interaction.guild.id) if interaction.guild else None
+    try:
+        new_timer = timer_scheduler.add(guild_id, interaction.channel_id, interaction.user.id, minutes * 60)
+    except TimerLimitError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return
+    await interaction.response.send_message(f"Timer #{new_timer['id']} set for {minutes} minute(s). I’ll notify you when it’s done!", ephemeral=True)
     logger.info(f"Timer started for {minutes} minutes by {interaction.user.name} (ID: {interaction.user.id})")
-    save_bot_log("timer", f"Timer started for {minutes} minutes by {interaction.user.name} (ID: {interaction.user.id})")
-    await asyncio.sleep(minutes * 60)
-    await interaction.followup.send(f"Timer finished for {interaction.user.mention}!")
-    logger.info(f"Timer expired for {interaction.user.name} (ID: {interaction.user.id})")
-    save_bot_log("timer", f"Timer expired for {interaction.user.name} (ID: {interaction.user.id})")
+    save_bot_log("timer", f"Timer {new_timer['id']} started for {minutes} minutes by {interaction.user.name} (ID: {interaction.user.id})")
+
+@bot.tree.command(name="timers", description="List your running timers")
+async def timers(interaction: discord.Interaction):
+    guild_id = str(interaction.guild.id) if interaction.guild else None
+    pending = timer_scheduler.pending(guild_id, interaction.user.id)
+    if not pending:
+        await interaction.response.send_message("You have no timers running.", ephemeral=True)
+        return
+    lines = [f"#{t['id']} — ends <t:{int(t['deadline'])}:R>" for t in pending]
+    await interaction.response.send_message("Your timers:\n" + "\n".join(lines), ephemeral=True)
+
+@bot.tree.command(name="canceltimer", description="Cancel one of your running timers")
+@discord.app_commands.describe(timer_id="The timer number shown by /timer or /timers")
+async def canceltimer(interaction: discord.Interaction, timer_id: int):
+    cancelled = timer_scheduler.cancel(timer_id, user_id=interaction.user.id)
+    if cancelled is None:
+        await interaction.response.send_message(f"You have no running timer #{timer_id}.", ephemeral=True)
+        return
+    await interaction.response.send_message(f"Timer #{timer_id} cancelled.", ephemeral=True)
+    save_bot_log("timer", f"Timer {timer_id} cancelled by {interaction.user.name} (ID: {interaction.user.id})")
 
 # Slash command: /resetcounts
 @bot.tree.command(name="resetcounts", description="Reset all message counts for this guild (admin only)")
+@timed(HANDLER_LATENCY, "/resetcounts")
 async def resetcounts(interaction: discord.Interaction):
     await interaction.response.defer()
     if not interaction.user.guild_permissions.administrator:
@@ -396,9 +776,13 @@ async def resetcounts(interaction: discord.Interaction):
 
     try:
         guild_id = str(interaction.guild.id)
+        running = backfills.pop(guild_id, None)
+        if running is not None:
+            running[1].cancel()
         # Reset data for this specific guild only
-        data = {"counts": {}, "timestamps": {}, "last_reset": int(time.time())}
-        save_message_counts(guild_id, data)
+        data = {"counts": {}, "activity": {}, "last_reset": int(time.time())}
+        guild_cache.replace(guild_id, data)
+        await guild_cache.flush()
         save_bot_log("reset", f"Message counts for guild {guild_id} reset by {interaction.user.name} (ID: {interaction.user.id})")
         await interaction.followup.send("Message counts and timestamps for this guild have been reset!", ephemeral=True)
         logger.info(f"Message counts and timestamps for guild {guild_id} reset")
@@ -406,63 +790,320 @@ async def resetcounts(interaction: discord.Interaction):
         logger.error(f"Error in /resetcounts command: {str(e)}")
         await interaction.followup.send("An error occurred while resetting counts. Please try again.", ephemeral=True)
 
-# Slash command: /setexcludedchannel
-@bot.tree.command(name="setexcludedchannel", description="Set the channel to exclude from message counting (admin only)")
-@discord.app_commands.check(lambda ctx: ctx.user.guild_permissions.administrator)
-async def setexcludedchannel(interaction: discord.Interaction):
-    await interaction.response.send_message("Please provide the channel ID to exclude (enable Developer Mode in Discord, right-click the channel, and copy its ID). Reply with the ID or 'cancel' to abort.", ephemeral=True)
+# ---------------------- /backfill ----------------------
+# guild_id -> (Backfill, task) for backfills running in this process
+backfills = {}
 
-    def check(m):
-        return m.author == interaction.user and m.channel == interaction.channel
+def format_backfill_progress(progress):
+    elapsed = (progress["finished"] or time.time()) - progress["started"]
+    rate = progress["messages"] / elapsed if elapsed > 0 else 0
+    text = (f"{progress['messages']:,} message(s) counted · {progress['channels_done']}/{progress['channels']} channel(s) done · "
+            f"{rate:,.0f} msg/s")
+    if progress["errors"]:
+        text += f" · {progress['errors']} channel(s) hit errors and will resume next time"
+    return text
 
+async def run_backfill(guild_id, job):
     try:
-        response = await bot.wait_for('message', check=check, timeout=60.0)
-        channel_id = response.content.strip()
-        if channel_id.lower() == 'cancel':
-            await interaction.followup.send("Action cancelled!", ephemeral=True)
+        progress = await job.run()
+        save_bot_log("backfill", f"Backfill of guild {guild_id} stopped: {format_backfill_progress(progress)}")
+    except (asyncio.CancelledError, BackfillCancelled):
+        save_bot_log("backfill", f"Backfill of guild {guild_id} cancelled")
+    except Exception as e:
+        logger.error(f"Backfill of guild {guild_id} failed: {e}")
+    finally:
+        running = backfills.get(guild_id)
+        if running and running[0] is job:
+            del backfills[guild_id]
+
+@bot.tree.command(name="backfill", description="Count this server's message history from before Strack's counts started (admin only)")
+@discord.app_commands.describe(action="start (or resume), status, or cancel")
+async def backfill(interaction: discord.Interaction, action: Literal["start", "status", "cancel"] = "status"):
+    if not interaction.guild or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need administrator permissions to use this command!", ephemeral=True)
+        return
+
+    guild_id = str(interaction.guild.id)
+    running = backfills.get(guild_id)
+    if action == "status":
+        if running:
+            await interaction.response.send_message(f"Backfill running: {format_backfill_progress(running[0].progress())}", ephemeral=True)
+            return
+        state = (await guild_cache.load(guild_id)).get("backfill")
+        if state is None:
+            await interaction.response.send_message("No backfill has been run since the last reset.", ephemeral=True)
+            return
+        status = "Finished" if state["finished"] else "Paused (use `/backfill start` to resume)"
+        await interaction.response.send_message(f"{status}: {format_backfill_progress(summarize_state(state))}", ephemeral=True)
+    elif action == "cancel":
+        if not running:
+            await interaction.response.send_message("No backfill is running.", ephemeral=True)
+            return
+        running[1].cancel()
+        await interaction.response.send_message("Backfill stopped. Progress is saved; `/backfill start` resumes it.", ephemeral=True)
+    else:
+        if running:
+            await interaction.response.send_message("A backfill is already running. Check it with `/backfill status`.", ephemeral=True)
+            return
+        job = Backfill(guild_cache, storage, guild_id, interaction.guild.text_channels,
+                       guild_configs.get(interaction.guild.id), concurrency=BACKFILL_CONCURRENCY)
+        if not await job.prepare():
+            await interaction.response.send_message("This server's history from before the last reset has already been counted.", ephemeral=True)
             return
+        if guild_id in backfills:
+            # Another start won the race while the guild was loading.
+            await interaction.response.send_message("A backfill is already running. Check it with `/backfill status`.", ephemeral=True)
+            return
+        resumed = job.progress()["messages"] > 0
+        backfills[guild_id] = (job, asyncio.create_task(run_backfill(guild_id, job)))
+        save_bot_log("backfill", f"Backfill of guild {guild_id} {'resumed' if resumed else 'started'} by {interaction.user.name} (ID: {interaction.user.id})")
+        await interaction.response.send_message(
+            f"Backfill {'resumed' if resumed else 'started'}: counting messages sent before <t:{int(job.state['cutoff'])}:f> "
+            f"in {len(job.channels)} channel(s). Check progress with `/backfill status`.", ephemeral=True)
 
-        try:
-            channel_id = int(channel_id)
-            channel = interaction.guild.get_channel(channel_id)
-            if not channel:
-                await interaction.followup.send("Invalid channel ID! The bot could not find this channel.", ephemeral=True)
-                return
+# ---------------------- /export ----------------------
+# guild_ids with an export in progress; one at a time per guild
+exports = set()
 
-            global EXCLUDED_CHANNEL_ID
-            EXCLUDED_CHANNEL_ID = channel_id
-            with open('.env', 'r') as file:
-                lines = file.readlines()
-            with open('.env', 'w') as file:
-                found = False
-                for line in lines:
-                    if line.startswith('EXCLUDED_CHANNEL_ID='):
-                        file.write(f'EXCLUDED_CHANNEL_ID={channel_id}\n')
-                        found = True
-                    else:
-                        file.write(line)
-                if not found:
-                    file.write(f'\nEXCLUDED_CHANNEL_ID={channel_id}\n')
-
-            save_bot_log("config", f"Excluded channel set to {channel_id} by {interaction.user.name} (ID: {interaction.user.id})")
-            await interaction.followup.send(f"Excluded channel set to ID {channel_id}! Strack will now ignore this channel.", ephemeral=True)
-            logger.info(f"Excluded channel updated to {channel_id} by {interaction.user.name}")
-        except ValueError:
-            await interaction.followup.send("Invalid channel ID! Please enter a valid number or 'cancel'.", ephemeral=True)
-        except PermissionError:
-            await interaction.followup.send("I don’t have permission to update the .env file. Please check file permissions!", ephemeral=True)
-            logger.error(f"Permission denied updating .env for {interaction.user.name}")
-        except Exception as e:
-            await interaction.followup.send("Something went wrong! Please try again.", ephemeral=True)
-            logger.error(f"Error setting excluded channel: {e}")
-    except asyncio.TimeoutError:
-        await interaction.followup.send("You took too long! Action cancelled.", ephemeral=True)
-        logger.warning(f"Timeout setting excluded channel for {interaction.user.name}")
+@bot.tree.command(name="export", description="Download this server's message statistics (admin only)")
+@discord.app_commands.describe(dataset="counts (all time), windows (last hour to 14 days) or daily (per user per day)",
+                               file_format="csv or ndjson (one JSON object per line)")
+@discord.app_commands.rename(file_format="format")
+@timed(HANDLER_LATENCY, "/export")
+async def export(interaction: discord.Interaction, dataset: Literal["counts", "windows", "daily"] = "counts",
+                 file_format: Literal["csv", "ndjson"] = "csv"):
+    if not interaction.guild or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need administrator permissions to use this command!", ephemeral=True)
+        return
+    guild_id = str(interaction.guild.id)
+    if guild_id in exports:
+        await interaction.response.send_message("An export for this server is already running.", ephemeral=True)
+        return
+
+    exports.add(guild_id)
+    await interaction.response.defer(ephemeral=True)
+    try:
+        # JSON storage exports the snapshot on disk, so write out pending counts first.
+        await guild_cache.flush()
+        part_size = min(EXPORT_PART_SIZE, interaction.guild.filesize_limit)
+        with tempfile.TemporaryDirectory(prefix="strack-export-") as directory:
+            paths = await asyncio.to_thread(export_guild, storage, guild_id, dataset, file_format, directory, part_size)
+            for i, path in enumerate(paths, 1):
+                await interaction.followup.send(f"`{dataset}` export, part {i} of {len(paths)} (gzip-compressed {file_format.upper()})",
+                                                file=discord.File(path), ephemeral=True)
+        save_bot_log("export", f"{dataset} export ({file_format}, {len(paths)} part(s)) of guild {guild_id} by {interaction.user.name} (ID: {interaction.user.id})")
+    except Exception as e:
+        logger.error(f"Error in /export for guild {guild_id}: {e}")
+        await interaction.followup.send("An error occurred while exporting. Please try again.", ephemeral=True)
+    finally:
+        exports.discard(guild_id)
+
+# ---------------------- /config ----------------------
+config_group = discord.app_commands.Group(name="config", description="Choose what Strack counts in this server (admin only)", guild_only=True)
+
+def describe_config(guild, config):
+    channels = ", ".join(f"<#{c}>" for c in sorted(config.excluded_channels)) or "none"
+    roles = ", ".join(f"<@&{r}>" for r in sorted(config.excluded_roles)) or "none"
+    embed = discord.Embed(title=f"⚙️ {guild.name} Settings")
+    embed.add_field(name="Ignored channels", value=channels, inline=False)
+    embed.add_field(name="Ignored roles", value=roles, inline=False)
+    embed.add_field(name="Only count members with a role", value="yes" if config.require_roles else "no", inline=False)
+    return embed
+
+async def update_config(interaction, message, **changes):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need administrator permissions to use this command!", ephemeral=True)
+        return
+    try:
+        config = await guild_configs.update(interaction.guild.id, **changes)
+    except Exception as e:
+        logger.error(f"Error saving config for guild {interaction.guild.id}: {e}")
+        await interaction.response.send_message("Something went wrong saving the settings! Please try again.", ephemeral=True)
+        return
+    save_bot_log("config", f"{message} in guild {interaction.guild.id} by {interaction.user.name} (ID: {interaction.user.id})")
+    await interaction.response.send_message(f"{message}.", embed=describe_config(interaction.guild, config), ephemeral=True)
+
+@config_group.command(name="show", description="Show what Strack ignores in this server")
+async def config_show(interaction: discord.Interaction):
+    await interaction.response.send_message(embed=describe_config(interaction.guild, guild_configs.get(interaction.guild.id)), ephemeral=True)
+
+@config_group.command(name="ignore-channel", description="Stop counting messages in a channel (and its threads)")
+async def config_ignore_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    await update_config(interaction, f"Now ignoring {channel.mention}", add={"excluded_channels": {channel.id}})
+
+@config_group.command(name="count-channel", description="Count messages in a previously ignored channel again")
+async def config_count_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    await update_config(interaction, f"Counting {channel.mention} again", remove={"excluded_channels": {channel.id}})
+
+@config_group.command(name="ignore-role", description="Stop counting messages from members with a role")
+async def config_ignore_role(interaction: discord.Interaction, role: discord.Role):
+    await update_config(interaction, f"Now ignoring members with {role.mention}", add={"excluded_roles": {role.id}})
+
+@config_group.command(name="count-role", description="Count messages from members with a previously ignored role again")
+async def config_count_role(interaction: discord.Interaction, role: discord.Role):
+    await update_config(interaction, f"Counting members with {role.mention} again", remove={"excluded_roles": {role.id}})
+
+@config_group.command(name="require-role", description="Only count members who have at least one role")
+@discord.app_commands.describe(enabled="Whether members without any role are ignored")
+async def config_require_role(interaction: discord.Interaction, enabled: bool):
+    await update_config(interaction, f"Members without a role are now {'ignored' if enabled else 'counted'}", require_roles=enabled)
+
+bot.tree.add_command(config_group)
+
+# Slash command: /setexcludedchannel (kept as a shortcut for /config ignore-channel)
+@bot.tree.command(name="setexcludedchannel", description="Exclude a channel from message counting in this server (admin only)")
+@discord.app_commands.describe(channel="The channel to stop counting")
+async def setexcludedchannel(interaction: discord.Interaction, channel: discord.TextChannel):
+    if not interaction.guild:
+        await interaction.response.send_message("Guild not available.", ephemeral=True)
+        return
+    await update_config(interaction, f"Now ignoring {channel.mention}", add={"excluded_channels": {channel.id}})
+
+# ---------------------- /activity ----------------------
+# Reports are cached per guild, user, window and offset for the current hour.
+analytics_cache = PageCache(ANALYTICS_CACHE_SIZE)
+
+async def get_activity_report(guild, user_id, window, utc_offset):
+    now = time.time()
+    key = ("activity", guild.id, user_id, window, utc_offset, int(now // 3600))
+    report = analytics_cache.get(key)
+    if report is not None:
+        return report
+    data = await guild_cache.load(str(guild.id))
+    activity = data["activity"]
+    if user_id is None:
+        histograms = list(activity.values())
+    else:
+        histograms = [activity[user_id]] if user_id in activity else []
+
+    rollups = None
+    window_days = WINDOWS[window]
+    if window_days > 14:
+        first_day = int(now // 86400) - window_days
+        if storage.persists_increments:
+            rollups = rows_to_arrays(await asyncio.to_thread(storage.daily_totals, guild.id, first_day, user_id))
+        else:
+            daily = data.get("daily", {})
+            rollups = rollup_arrays(daily if user_id is None else {user_id: daily.get(user_id, {})})
+    with HANDLER_LATENCY.timer("activity_report"):
+        report = await build_report(histograms, window_days, now, rollups, utc_offset)
+    analytics_cache.put(key, report)
+    return report
+
+def format_hour_range(hour, utc_offset):
+    zone = f"UTC{utc_offset:+d}" if utc_offset else "UTC"
+    return f"{hour:02d}:00–{(hour + 1) % 24:02d}:00 {zone}"
+
+@bot.tree.command(name="activity", description="Show when this server (or a member) is most active")
+@discord.app_commands.describe(window="How far back to look; defaults to 14d",
+                               user="Show one member's activity instead of the whole server's",
+                               utc_offset="Your timezone as hours from UTC (e.g. -5 or 2); defaults to UTC")
+@timed(HANDLER_LATENCY, "/activity")
+async def activity(interaction: discord.Interaction, window: Literal["7d", "14d", "30d", "90d", "365d"] = "14d",
+                   user: discord.Member = None, utc_offset: discord.app_commands.Range[int, -12, 14] = 0):
+    guild = interaction.guild
+    if not guild:
+        await interaction.response.send_message("Guild not available.", ephemeral=True)
+        return
+    await interaction.response.defer()
+    try:
+        report = await get_activity_report(guild, str(user.id) if user else None, window, utc_offset)
+        if not report.total:
+            await interaction.followup.send("No messages found for this timeframe.", ephemeral=True)
+            return
+
+        subject = user.display_name if user else guild.name
+        embed = discord.Embed(title=f"📈 {subject} Activity (last {window})", timestamp=datetime.utcnow())
+        embed.description = (f"Messages by weekday and hour (last {report.heatmap_days} days, "
+                             f"{'UTC' if not utc_offset else f'UTC{utc_offset:+d}'}):\n```\n{render_heatmap(report.heatmap)}\n```")
+        average = report.total / report.window_days
+        embed.add_field(name="Daily messages", value=f"`{render_trend(report.trend)}`\n{report.total:,} total · {average:,.1f}/day", inline=False)
+        slots = [f"{WEEKDAYS[weekday]} {format_hour_range(hour, utc_offset)} — {count:,}" for weekday, hour, count in report.busiest_slots()]
+        if slots:
+            embed.add_field(name="Busiest times", value="\n".join(slots), inline=True)
+        peaks = []
+        busiest_day = report.busiest_day()
+        if busiest_day:
+            peaks.append(f"Busiest day: <t:{busiest_day[0]}:D> — {busiest_day[1]:,}")
+        if report.peak_hour:
+            peaks.append(f"Busiest hour: <t:{report.peak_hour[0]}:f> — {report.peak_hour[1]:,}")
+        if peaks:
+            embed.add_field(name="Peaks", value="\n".join(peaks), inline=True)
+        await interaction.followup.send(embed=embed)
+    except Exception as e:
+        logger.error(f"Error in /activity: {e}")
+        await interaction.followup.send("An error occurred while building the activity report. Please try again.", ephemeral=True)
+
+# ---------------------- /stats ----------------------
+def format_latency(histogram, label):
+    p50, p99 = histogram.quantile(0.5, label), histogram.quantile(0.99, label)
+    if p50 is None:
+        return "no data"
+    return f"p50 {p50 * 1000:.2f}ms · p99 {p99 * 1000:.2f}ms · {histogram.count(label)} calls"
+
+@bot.tree.command(name="stats", description="Show bot performance statistics (admin only)")
+async def stats(interaction: discord.Interaction):
+    if not interaction.guild or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need administrator permissions to use this command!", ephemeral=True)
+        return
+
+    lookups = guild_cache.hits + guild_cache.misses
+    hit_rate = f"{guild_cache.hits / lookups:.1%}" if lookups else "n/a"
+    embed = discord.Embed(title="📊 Strack Stats", timestamp=datetime.utcnow())
+    embed.add_field(name="Gateway latency", value=f"{round(bot.latency * 1000)}ms", inline=True)
+    embed.add_field(name="Messages counted", value=f"{MESSAGES_PROCESSED.total()} ({MESSAGES_PROCESSED.value(str(interaction.guild.id))} here)", inline=True)
+    embed.add_field(name="Cached guilds", value=f"{len(guild_cache)} · hit rate {hit_rate}", inline=True)
+    for label in ("on_message", "/leaderboard", "/rolecount"):
+        embed.add_field(name=label, value=format_latency(HANDLER_LATENCY, label), inline=False)
+    for label in ("load", "save", "flush"):
+        embed.add_field(name=f"storage {label}", value=format_latency(STORAGE_LATENCY, label), inline=False)
+    embed.add_field(name="Pending timers", value=str(len(timer_scheduler)), inline=True)
+    sent = sum(n for (_, outcome), n in dispatcher.outcomes.items() if outcome == "sent")
+    coalesced = sum(n for (_, outcome), n in dispatcher.outcomes.items() if outcome == "coalesced")
+    embed.add_field(name="Outbound queue", value=f"{len(dispatcher)} queued · {sent} sent · {coalesced} coalesced · "
+                    f"wait {format_latency(DISPATCH_WAIT, 'reply')}", inline=False)
+    if compactor.last_run:
+        totals = compactor.totals
+        embed.add_field(name="Compaction", value=f"last run <t:{int(compactor.last_run)}:R> · {totals['messages'] + totals['events']} "
+                        f"message(s) rolled up · {totals['histograms']} histogram(s) freed", inline=True)
+    shards = [f"#{s}: {'🟢' if up else '🔴'} {round(latency * 1000)}ms · {guilds} servers · {SHARD_MESSAGES.value(str(s))} msgs"
+              for s, (up, latency, guilds) in sorted(shard_health().items())]
+    embed.add_field(name=f"Shards (cluster {CLUSTER_ID + 1}/{CLUSTER_COUNT})", value="\n".join(shards[:16]) or "none", inline=False)
+    embed.add_field(name="Profiler", value="running" if profiler.running else "off", inline=True)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+# ---------------------- /profile ----------------------
+@bot.tree.command(name="profile", description="Start or stop the built-in profiler (bot owner only)")
+@discord.app_commands.describe(action="start, stop, or status")
+async def profile(interaction: discord.Interaction, action: Literal["start", "stop", "status"]):
+    # The profiler sees the whole process, not just one guild, so it's limited to the bot owner.
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot owner can use the profiler.", ephemeral=True)
+        return
+
+    if action == "start":
+        profiler.start()
+        await interaction.response.send_message("Profiler started. Use `/profile stop` to see the results.", ephemeral=True)
+    elif action == "stop":
+        path = f"strack-{int(time.time())}.prof"
+        summary = profiler.stop(path)
+        if summary is None:
+            await interaction.response.send_message("The profiler isn't running.", ephemeral=True)
+            return
+        await interaction.response.send_message(f"Profile saved to `{path}`.\n```{summary[-1800:]}```", ephemeral=True)
+    else:
+        state = f"running since <t:{int(profiler.started_at)}:R>" if profiler.running else "off"
+        await interaction.response.send_message(f"Profiler is {state}.", ephemeral=True)
+    save_bot_log("profile", f"Profiler {action} by {interaction.user.name} (ID: {interaction.user.id})")
 
 # Bot token from .env
 if __name__ == "__main__":
     bot_token = os.getenv('BOT_TOKEN')
     if bot_token:
         bot.run(bot_token)
+        # The event loop is gone by now; write out anything the last flush missed.
+        guild_cache.flush_sync()
+        storage.close()
+        event_log.flush()
     else:
         logger.error("BOT_TOKEN not found in .env file. Please set the environment variable.")
@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers go first.
+NOTIFY = 0      # messages someone is waiting for, like finished timers
+REPLY = 1       # cosmetic replies, like answering a mention
+PRIORITY_NAMES = {NOTIFY: "notify", REPLY: "reply"}
+
+
+class DispatchDropped(Exception):
+    """A message passed to Dispatcher.deliver was dropped before it was sent."""
+
+
+class Dispatcher:
+    """Sends the bot's own channel messages from background workers, so the
+    handlers that produce them return without waiting on Discord.
+
+    Every channel has its own priority queue, drained by at most one worker,
+    so one busy channel can't hold up the others and Discord's per-channel
+    rate limit is hit by one request at a time. A semaphore bounds how many
+    sends run at once overall. Interaction responses don't go through here:
+    they use the interaction's own webhook, which has separate rate limits, and
+    must be answered within three seconds.
+
+    Sends with a `key` are coalesced: for `cooldown` seconds after one is
+    queued, further sends with the same key to the same channel are dropped.
+    Messages that must not be lost go through `deliver`, which waits for the
+    send and raises if it failed or was dropped, so the caller can retry.
+    """
+
+    def __init__(self, concurrency=8, max_per_channel=50, cooldown=10, wait_histogram=None):
+        self.max_per_channel = max_per_channel
+        self.cooldown = cooldown
+        self.wait_histogram = wait_histogram    # observes seconds queued, labelled by priority name
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues = {}       # channel_id -> heap of (priority, seq, queued_at, channel, kwargs, future or None)
+        self._workers = {}      # channel_id -> draining task
+        self._recent = {}       # (channel_id, key) -> time a send with that key was queued
+        self._seq = itertools.count()
+        self.outcomes = {}      # (priority name, outcome) -> count
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def depth(self):
+        """Queued messages per priority name."""
+        depth = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+        for queue in self._queues.values():
+            for item in queue:
+                depth[PRIORITY_NAMES[item[0]]] += 1
+        return depth
+
+    @property
+    def busy_channels(self):
+        return len(self._workers)
+
+    def send(self, channel, content=None, *, priority=REPLY, key=None, **kwargs):
+        """Queues channel.send(content, **kwargs). Returns False if it was dropped."""
+        return self._enqueue(channel, dict(kwargs, content=content), priority, key, None)
+
+    async def deliver(self, channel, content=None, *, priority=NOTIFY, **kwargs):
+        """Queues channel.send(content, **kwargs) and waits until it has been sent.
+        Raises DispatchDropped if it was dropped, or the error the send failed with."""
+        done = asyncio.get_running_loop().create_future()
+        if not self._enqueue(channel, dict(kwargs, content=content), priority, None, done):
+            raise DispatchDropped(f"Outbound queue for channel {channel.id} is full")
+        await done
+
+    def _enqueue(self, channel, kwargs, priority, key, done):
+        now = time.monotonic()
+        if key is not None and now - self._recent.get((channel.id, key), -self.cooldown) < self.cooldown:
+            self._count(priority, "coalesced")
+            return False
+
+        queue = self._queues.setdefault(channel.id, [])
+        if len(queue) >= self.max_per_channel:
+            # Full: make room by dropping the newest of the least urgent messages, if
+            # that's less urgent than this one; otherwise drop this one.
+            worst = max(queue)
+            if worst[0] <= priority:
+                self._count(priority, "overflow")
+                return False
+            queue.remove(worst)
+            heapq.heapify(queue)
+            self._count(worst[0], "overflow")
+            self._settle(worst[5], DispatchDropped(f"Outbound queue for channel {channel.id} is full"))
+        heapq.heappush(queue, (priority, next(self._seq), now, channel, kwargs, done))
+        if key is not None:
+            # Only a send that was actually queued starts the cooldown.
+            self._recent[(channel.id, key)] = now
+            if len(self._recent) > 10_000:
+                self._recent = {k: t for k, t in self._recent.items() if now - t < self.cooldown}
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._drain(channel.id))
+        return True
+
+    async def _drain(self, channel_id):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                priority, _, queued_at, channel, kwargs, done = heapq.heappop(queue)
+                async with self._slots:
+                    if self.wait_histogram is not None:
+                        self.wait_histogram.observe(time.monotonic() - queued_at, PRIORITY_NAMES[priority])
+                    try:
+                        await channel.send(**kwargs)
+                        self._count(priority, "sent")
+                        self._settle(done)
+                    except discord.Forbidden as e:
+                        # Nothing else queued for this channel can go through either.
+                        logger.info(f"No permission to send in channel {channel_id}; dropping {len(queue) + 1} message(s)")
+                        for item in queue:
+                            self._count(item[0], "failed")
+                            self._settle(item[5], e)
+                        queue.clear()
+                        self._count(priority, "failed")
+                        self._settle(done, e)
+                    except discord.HTTPException as e:
+                        logger.error(f"Error sending to channel {channel_id}: {e}")
+                        self._count(priority, "failed")
+                        self._settle(done, e)
+                    except Exception as e:
+                        self._settle(done, e)
+                        raise
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+
+    @staticmethod
+    def _settle(done, error=None):
+        """Resolves a deliver() future, unless there is none or its caller gave up."""
+        if done is None or done.done():
+            return
+        if error is None:
+            done.set_result(None)
+        else:
+            done.set_exception(error)
+
+    def _count(self, priority, outcome):
+        key = (PRIORITY_NAMES[priority], outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
@@ -0,0 +1,175 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+
+
+def make_entry(event, details, ts=None):
+    ts = time.time() if ts is None else ts
+    return {
+        "ts": round(ts, 3),
+        "timestamp": datetime.fromtimestamp(ts, timezone.utc).strftime(TIMESTAMP_FORMAT),
+        "event": event,
+        "details": details
+    }
+
+
+class EventLog:
+    """Append-only JSON Lines event log.
+
+    `append` only buffers the entry in memory; `flush` (run periodically in a
+    worker thread) appends everything buffered to the current segment and
+    rotates it once it is too big or too old. Rotated segments are renamed to
+    `<path>.<YYYYmmdd-HHMMSS-ffffff>` and optionally gzipped.
+    """
+
+    def __init__(self, path='bot_logs.jsonl', max_bytes=10 * 1024 * 1024, rotate_seconds=0, compress=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._segment_started = self._read_segment_start()
+        self.bytes_written = 0
+
+    def _read_segment_start(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.loads(f.readline()).get("ts", time.time())
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def append(self, event, details):
+        with self._lock:
+            self._buffer.append(make_entry(event, details))
+
+    def flush(self):
+        """Writes buffered entries to disk. Safe to call from any thread."""
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return 0
+        with self._write_lock:
+            if self._should_rotate(entries[0]["ts"]):
+                self._rotate()
+            data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+            if self._segment_started is None:
+                self._segment_started = entries[0]["ts"]
+            self.bytes_written += len(data)
+        return len(entries)
+
+    def _should_rotate(self, now):
+        if self._segment_started is None:
+            return False
+        if self.rotate_seconds and now - self._segment_started >= self.rotate_seconds:
+            return True
+        try:
+            return os.path.getsize(self.path) >= self.max_bytes
+        except OSError:
+            return False
+
+    def _rotate(self):
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+        rotated = f"{self.path}.{stamp}"
+        try:
+            os.replace(self.path, rotated)
+            if self.compress:
+                with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+        except Exception as e:
+            logger.error(f"Error rotating {self.path}: {e}")
+        self._segment_started = None
+
+
+def segments(path='bot_logs.jsonl'):
+    """Returns every segment of a log, oldest first, ending with the live file."""
+    rotated = sorted(p for p in glob.glob(glob.escape(path) + '.*') if not p.endswith('.tmp'))
+    return rotated + ([path] if os.path.exists(path) else [])
+
+def iter_events(path='bot_logs.jsonl', event=None, since=None, until=None):
+    """Streams log entries, optionally filtered by event type and Unix time range."""
+    events = {event} if isinstance(event, str) else set(event) if event else None
+    for segment in segments(path):
+        opener = gzip.open if segment.endswith('.gz') else open
+        try:
+            with opener(segment, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    ts = entry.get("ts", 0)
+                    if events and entry.get("event") not in events:
+                        continue
+                    if since is not None and ts < since:
+                        continue
+                    if until is not None and ts >= until:
+                        continue
+                    yield entry
+        except OSError as e:
+            logger.error(f"Error reading {segment}: {e}")
+
+def convert_legacy_log(src='bot_logs.json', dst='bot_logs.jsonl'):
+    """Appends the entries of an old {"logs": [...]} file to a JSON Lines log."""
+    with open(src, 'r') as f:
+        logs = json.load(f).get("logs", [])
+    converted = 0
+    with open(dst, 'a', encoding='utf-8') as out:
+        for entry in logs:
+            try:
+                ts = datetime.strptime(entry["timestamp"], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+            except (KeyError, ValueError):
+                continue
+            out.write(json.dumps(make_entry(entry.get("event"), entry.get("details"), ts), ensure_ascii=False) + "\n")
+            converted += 1
+    return converted
+
+def _parse_time(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp() if value else None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    args = sys.argv[1:]
+    # The log to query: --file PATH, else BOT_LOGS_FILE, else the bot's default.
+    log_file = os.getenv('BOT_LOGS_FILE', 'bot_logs.jsonl')
+    if '--file' in args:
+        i = args.index('--file')
+        if i + 1 >= len(args):
+            print("--file needs a path")
+            sys.exit(1)
+        log_file = args[i + 1]
+        del args[i:i + 2]
+    if args[:1] == ['convert']:
+        src = args[1] if len(args) > 1 else 'bot_logs.json'
+        dst = args[2] if len(args) > 2 else log_file
+        logger.info(f"Converted {convert_legacy_log(src, dst)} entries from {src} to {dst}")
+    elif args[:1] == ['query']:
+        # python event_log.py query [event] [since YYYY-MM-DD[THH:MM]] [until ...] [--file PATH]
+        event = args[1] if len(args) > 1 and args[1] != '-' else None
+        since = _parse_time(args[2]) if len(args) > 2 else None
+        until = _parse_time(args[3]) if len(args) > 3 else None
+        for entry in iter_events(log_file, event, since, until):
+            print(f"{entry['timestamp']}  {entry['event']}: {entry['details']}")
+    else:
+        print("Usage: python event_log.py convert [bot_logs.json] [bot_logs.jsonl]\n"
+              "       python event_log.py query [event|-] [since] [until] [--file bot_logs.jsonl]")
+        sys.exit(1)
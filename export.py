@@ -0,0 +1,167 @@
+"""Streaming export of a guild's statistics as CSV or NDJSON.
+
+Rows are produced by generators straight from storage (SQLite cursors, or
+the guild's JSON file as stored, one user's histogram at a time), encoded line by line and compressed on the fly into
+numbered part files of bounded size, so an export never holds more than one
+part's worth of output in memory. Every part is a standalone file with its
+own CSV header and gzip stream.
+
+Datasets:
+    counts    user_id, messages                      (all-time counts)
+    windows   user_id, messages_1h ... messages_14d  (users active in the last 14 days)
+    daily     user_id, date, messages                (daily rollups plus recent activity)
+
+From the command line (safe to run next to the bot with SQLite; with JSON
+storage it reads the last flushed snapshot):
+
+    python export.py <guild_id> daily --format ndjson --output exports/
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from compaction import DAY
+
+logger = logging.getLogger(__name__)
+
+DATASETS = ("counts", "windows", "daily")
+FORMATS = ("csv", "ndjson")
+WINDOWS = {"1h": 3600, "24h": 86400, "7d": 604800, "14d": 1209600}
+COLUMNS = {
+    "counts": ("user_id", "messages"),
+    "windows": ("user_id",) + tuple(f"messages_{name}" for name in WINDOWS),
+    "daily": ("user_id", "date", "messages"),
+}
+PART_SIZE = 8 * 1024 * 1024     # bytes per part; below Discord's default 10 MiB upload limit
+# zlib keeps some input buffered before emitting it, so a gzip part is closed
+# this far below the limit.
+COMPRESSION_SLACK = 256 * 1024
+
+
+def dataset_rows(storage, guild_id, dataset, now=None):
+    """Yields the rows of one dataset, ordered by user."""
+    now = now or time.time()
+    if dataset == "counts":
+        yield from storage.iter_counts(guild_id)
+    elif dataset == "windows":
+        yield from storage.iter_window_counts(guild_id, [int(now - seconds) for seconds in WINDOWS.values()])
+    else:
+        for user_id, day, n in storage.iter_daily(guild_id):
+            yield user_id, format_day(day), n
+
+def format_day(day):
+    return datetime.fromtimestamp(day * DAY, timezone.utc).strftime("%Y-%m-%d")
+
+
+def encode_lines(rows, columns, fmt):
+    """Yields one encoded line (bytes) per row."""
+    if fmt == "ndjson":
+        for row in rows:
+            yield (json.dumps(dict(zip(columns, row))) + "\n").encode()
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+def csv_header(columns):
+    return (",".join(columns) + "\n").encode()
+
+
+class _PartFile:
+    """One output file, optionally gzip-compressed, that tracks the bytes written."""
+
+    def __init__(self, path, compress):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None   # wbits=31: gzip
+        self.size = 0
+
+    def write(self, chunk):
+        out = self._compressor.compress(chunk) if self._compressor else chunk
+        self._file.write(out)
+        self.size += len(out)
+
+    def close(self):
+        if self._compressor:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+
+
+def write_parts(lines, directory, stem, extension, part_size=PART_SIZE, compress=True, header=b""):
+    """Writes lines into <stem>-001.<extension>[.gz], <stem>-002..., under
+    `directory`, starting a new part before one would exceed part_size bytes.
+    Returns the paths written (at least one, even for no rows)."""
+    limit = part_size - (COMPRESSION_SLACK if compress else 0) - len(header)
+    if limit <= 0:
+        raise ValueError(f"Part size of {part_size} bytes is too small")
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+
+    def next_part():
+        paths.append(os.path.join(directory, f"{stem}-{len(paths) + 1:03d}.{extension}" + (".gz" if compress else "")))
+        part = _PartFile(paths[-1], compress)
+        part.write(header)
+        return part
+
+    part = next_part()
+    try:
+        for line in lines:
+            if part.size + len(line) > limit:
+                part.close()
+                part = next_part()
+            part.write(line)
+    finally:
+        part.close()
+    return paths
+
+
+def export_guild(storage, guild_id, dataset, fmt="csv", directory=".", part_size=PART_SIZE, compress=True, now=None):
+    """Exports one dataset of a guild into part files and returns their paths.
+    Blocking; call it from a worker thread in the bot."""
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset: {dataset}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    now = now or time.time()
+    columns = COLUMNS[dataset]
+    stamp = datetime.fromtimestamp(now, timezone.utc).strftime("%Y%m%d-%H%M%S")
+    lines = encode_lines(dataset_rows(storage, guild_id, dataset, now), columns, fmt)
+    return write_parts(lines, directory, f"strack-{guild_id}-{dataset}-{stamp}", fmt, part_size, compress,
+                       csv_header(columns) if fmt == "csv" else b"")
+
+
+if __name__ == "__main__":
+    from storage import create_storage
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Export a guild's message statistics")
+    parser.add_argument('guild_id', type=int)
+    parser.add_argument('dataset', choices=DATASETS)
+    parser.add_argument('--format', choices=FORMATS, default="csv")
+    parser.add_argument('--output', default=".", help="directory for the part files")
+    parser.add_argument('--part-size', type=float, default=PART_SIZE / 1024 / 1024, help="MiB per part file")
+    parser.add_argument('--no-gzip', action='store_true', help="write plain text parts")
+    args = parser.parse_args()
+
+    storage = create_storage(os.getenv('STORAGE_BACKEND', 'json'), path=os.getenv('SQLITE_PATH', 'strack.db'))
+    storage.start()
+    try:
+        paths = export_guild(storage, args.guild_id, args.dataset, args.format, args.output,
+                             int(args.part_size * 1024 * 1024), not args.no_gzip)
+        for path in paths:
+            logger.info(f"Wrote {path} ({os.path.getsize(path):,} bytes)")
+    finally:
+        storage.close()
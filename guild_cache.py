@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from storage import serialize_message_counts, snapshot_message_counts
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_weight(data):
+    """Rough size of a guild's data: one unit per tracked count, activity histogram and rollup user."""
+    return len(data.get("counts", {})) + len(data.get("activity", {})) + len(data.get("daily", {}))
+
+
+class GuildCache:
+    """Resident per-guild message count state with write-back persistence.
+
+    Guilds are loaded on first access and kept in LRU order. Mutations only mark
+    a guild dirty; dirty guilds are written out by `flush()`, which runs on a
+    timer, when the dirty threshold is reached, and on disconnect/shutdown.
+    """
+
+    def __init__(self, loader, saver, max_entries=2_000_000, dirty_threshold=500):
+        self._loader = loader
+        self._saver = saver
+        self.max_entries = max_entries
+        self.dirty_threshold = dirty_threshold
+        self._guilds = OrderedDict()    # guild_id -> data
+        self._weights = {}              # guild_id -> estimated weight
+        self._dirty = set()
+        self._evicted = {}              # dirty guilds evicted before their next flush
+        self._pending_changes = 0
+        self._total_weight = 0
+        self._flush_lock = asyncio.Lock()
+        self._loading = {}              # guild_id -> task loading it in a worker thread
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, guild_id):
+        return guild_id in self._guilds
+
+    def __len__(self):
+        return len(self._guilds)
+
+    @property
+    def total_weight(self):
+        return self._total_weight
+
+    def get(self, guild_id):
+        """Returns the resident data for a guild, loading it from storage on a miss.
+        Blocks on the load; handlers on the event loop use `load` instead."""
+        data = self._guilds.get(guild_id)
+        if data is not None:
+            self.hits += 1
+            self._guilds.move_to_end(guild_id)
+            return data
+        self.misses += 1
+        data = self._evicted.pop(guild_id, None)
+        if data is not None:
+            # Still waiting to be written; keep it dirty so the pending write isn't lost.
+            self._dirty.add(guild_id)
+        else:
+            data = self._loader(guild_id)
+        self._insert(guild_id, data)
+        return data
+
+    async def load(self, guild_id):
+        """Like `get`, but a miss is loaded from storage in a worker thread, so a
+        cold or evicted guild doesn't stall the event loop. Concurrent callers for
+        the same guild share one load."""
+        if guild_id in self._guilds or guild_id in self._evicted:
+            return self.get(guild_id)
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id))
+        return await asyncio.shield(task)
+
+    async def _load(self, guild_id):
+        try:
+            data = await asyncio.to_thread(self._loader, guild_id)
+        finally:
+            del self._loading[guild_id]
+        if guild_id in self._guilds or guild_id in self._evicted:
+            # Loaded or replaced by someone else in the meantime; theirs is newer.
+            return self.get(guild_id)
+        self.misses += 1
+        self._insert(guild_id, data)
+        return data
+
+    def peek(self, guild_id):
+        """Returns a resident guild's data without loading it or touching LRU order."""
+        return self._guilds.get(guild_id)
+
+    def resident_ids(self):
+        return list(self._guilds)
+
+    def replace(self, guild_id, data):
+        """Replaces a guild's data (e.g. on reset) and marks it dirty."""
+        self._evicted.pop(guild_id, None)
+        if guild_id in self._guilds:
+            self._total_weight -= self._weights.pop(guild_id, 0)
+            del self._guilds[guild_id]
+        self._insert(guild_id, data)
+        self.mark_dirty(guild_id)
+
+    def mark_dirty(self, guild_id, weight_delta=0):
+        """Records a change to a resident guild. Returns True once a flush is due."""
+        self._dirty.add(guild_id)
+        self._pending_changes += 1
+        self.add_weight(guild_id, weight_delta)
+        return self.needs_flush()
+
+    def add_weight(self, guild_id, weight_delta):
+        """Adjusts a resident guild's size estimate, e.g. after a new user was added."""
+        if weight_delta and guild_id in self._weights:
+            self._weights[guild_id] += weight_delta
+            self._total_weight += weight_delta
+            self._evict()
+
+    def needs_flush(self):
+        return self._pending_changes >= self.dirty_threshold and not self._flush_lock.locked()
+
+    def _insert(self, guild_id, data):
+        weight = estimate_weight(data)
+        self._guilds[guild_id] = data
+        self._weights[guild_id] = weight
+        self._total_weight += weight
+        self._evict()
+
+    def _evict(self):
+        # Never evict the most recently used guild, even if it alone exceeds the cap.
+        while self._total_weight > self.max_entries and len(self._guilds) > 1:
+            guild_id, data = self._guilds.popitem(last=False)
+            self._total_weight -= self._weights.pop(guild_id, 0)
+            if guild_id in self._dirty:
+                self._dirty.discard(guild_id)
+                self._evicted[guild_id] = data
+            logger.debug(f"Evicted guild {guild_id} from message count cache")
+
+    def _collect_dirty(self):
+        """Takes cheap copies of the dirty guilds; serializing them is left to `_write`,
+        off the event loop. Evicted guilds are no longer reachable, so they go as they are."""
+        snapshots = dict(self._evicted)
+        for guild_id in self._dirty:
+            snapshots[guild_id] = snapshot_message_counts(self._guilds[guild_id])
+        self._evicted.clear()
+        self._dirty.clear()
+        self._pending_changes = 0
+        return snapshots
+
+    def _write(self, snapshots):
+        for guild_id, data in snapshots.items():
+            self._saver(guild_id, serialize_message_counts(data))
+
+    async def flush(self):
+        """Writes all dirty guilds in a worker thread so the event loop keeps running."""
+        async with self._flush_lock:
+            snapshots = self._collect_dirty()
+            if snapshots:
+                await asyncio.to_thread(self._write, snapshots)
+                logger.debug(f"Flushed message counts for {len(snapshots)} guild(s)")
+            return len(snapshots)
+
+    async def save_cold(self, guild_id, data, unchanged):
+        """Saves a guild that was read and modified outside the cache (e.g. compacted
+        on disk). Skipped, returning False, if the guild is cached, loading or has
+        unsaved changes, or if `unchanged()` says the stored copy moved on. Holds the
+        flush lock so no flush of the same guild can interleave."""
+        async with self._flush_lock:
+            if (guild_id in self._guilds or guild_id in self._evicted or guild_id in self._loading
+                    or not await asyncio.to_thread(unchanged)):
+                return False
+            await asyncio.to_thread(self._write, {guild_id: data})
+            return True
+
+    def flush_sync(self):
+        """Writes all dirty guilds immediately; used at shutdown once the loop is gone."""
+        snapshots = self._collect_dirty()
+        self._write(snapshots)
+        return len(snapshots)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GuildConfig:
+    """One guild's counting rules. Instances are never modified in place;
+    updates build a new one with `replace`, so readers always see a
+    consistent config."""
+
+    __slots__ = ("excluded_channels", "excluded_roles", "require_roles")
+
+    def __init__(self, excluded_channels=(), excluded_roles=(), require_roles=False):
+        self.excluded_channels = frozenset(excluded_channels)
+        self.excluded_roles = frozenset(excluded_roles)
+        self.require_roles = require_roles      # only count members with at least one role
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return GuildConfig(**values)
+
+    def counts(self, message):
+        """Whether a (non-bot, guild) message should be counted under these rules."""
+        channel = message.channel
+        if channel.id in self.excluded_channels or getattr(channel, "parent_id", None) in self.excluded_channels:
+            return False
+        if not self.excluded_roles and not self.require_roles:
+            return True
+        # Authors that aren't members any more (e.g. in backfilled history) have no roles.
+        roles = getattr(message.author, "roles", None)
+        role_ids = {role.id for role in roles if not role.is_default()} if roles else set()
+        if self.require_roles and not role_ids:
+            return False
+        return self.excluded_roles.isdisjoint(role_ids)
+
+    def to_dict(self):
+        return {
+            "excluded_channels": sorted(self.excluded_channels),
+            "excluded_roles": sorted(self.excluded_roles),
+            "require_roles": self.require_roles,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("excluded_channels", ()), data.get("excluded_roles", ()), data.get("require_roles", False))
+
+
+class GuildConfigStore:
+    """All guild configs, loaded once and looked up from memory.
+
+    Guilds that were never configured share one default config, which
+    excludes the legacy EXCLUDED_CHANNEL_ID if that is still set. Updates are
+    written through the storage backend first and only then swapped in.
+    """
+
+    def __init__(self, storage, default=None):
+        self._storage = storage
+        self.default = default or GuildConfig()
+        self._configs = {}          # guild_id (int) -> GuildConfig
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        self._configs = {int(g): GuildConfig.from_dict(data) for g, data in self._storage.load_configs().items()}
+        logger.info(f"Loaded configuration for {len(self._configs)} guild(s)")
+
+    def get(self, guild_id):
+        return self._configs.get(guild_id, self.default)
+
+    async def update(self, guild_id, add=None, remove=None, **changes):
+        """Persists a changed config for a guild and makes it live. Returns the new config.
+
+        `add` and `remove` map a set field (e.g. "excluded_channels") to IDs to add
+        to or remove from it. They are applied to the config as it is under the lock,
+        so concurrent changes to the same set don't overwrite each other.
+        """
+        async with self._lock:
+            current = self.get(guild_id)
+            for name, ids in (add or {}).items():
+                changes[name] = getattr(current, name) | set(ids)
+            for name, ids in (remove or {}).items():
+                changes[name] = changes.get(name, getattr(current, name)) - set(ids)
+            config = current.replace(**changes)
+            await asyncio.to_thread(self._storage.save_config, str(guild_id), config.to_dict())
+            self._configs[guild_id] = config
+            return config
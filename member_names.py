@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH = 100       # user IDs per gateway member query (Discord's maximum)
+_UNRESOLVED = object()  # a lookup that failed for another reason than the user having left
+
+
+class MemberNameCache:
+    """TTL cache of display names for members resolved on demand.
+
+    Used when the member list isn't chunked: only users about to be shown are
+    looked up. A cached name of None means the user has left the guild; those
+    entries live longer, since departed users rarely come back.
+    """
+
+    def __init__(self, ttl=3600, departed_ttl=86400, max_entries=100_000):
+        self.ttl = ttl
+        self.departed_ttl = departed_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # (guild_id, user_id) -> (expires, display name or None)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, guild_id, user_id):
+        """Returns (display_name_or_None,) for a live entry, or None if unknown/expired."""
+        key = (guild_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return (entry[1],)
+
+    def put(self, guild_id, user_id, name):
+        ttl = self.ttl if name is not None else self.departed_ttl
+        self._entries[(guild_id, user_id)] = (time.monotonic() + ttl, name)
+        self._entries.move_to_end((guild_id, user_id))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, guild_id, user_id):
+        self._entries.pop((guild_id, user_id), None)
+
+
+def missing_members(guild, user_ids, cache):
+    """Returns the given user IDs that are neither in the member cache nor in `cache`."""
+    return [uid for uid in user_ids if guild.get_member(uid) is None and cache.get(guild.id, uid) is None]
+
+async def resolve_members(guild, user_ids, cache):
+    """Looks up the given user IDs that are neither in the member cache nor in
+    `cache`, 100 per gateway query, and records who was found and who has left.
+    Falls back to one REST fetch per user if the gateway query isn't possible."""
+    missing = missing_members(guild, user_ids, cache)
+    for start in range(0, len(missing), QUERY_BATCH):
+        batch = missing[start:start + QUERY_BATCH]
+        try:
+            found = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+            results = {uid: None for uid in batch}
+            results.update((member.id, member.display_name) for member in found)
+        except (asyncio.TimeoutError, discord.ClientException) as e:
+            logger.debug(f"Member query for guild {guild.id} failed ({e}); fetching members one by one")
+            results = dict(zip(batch, await asyncio.gather(*(_fetch_display_name(guild, uid) for uid in batch))))
+        for uid, name in results.items():
+            if name is not _UNRESOLVED:
+                cache.put(guild.id, uid, name)
+
+async def _fetch_display_name(guild, user_id):
+    try:
+        return (await guild.fetch_member(user_id)).display_name
+    except discord.NotFound:
+        return None
+    except discord.HTTPException as e:
+        logger.debug(f"Could not fetch member {user_id} of guild {guild.id}: {e}")
+        return _UNRESOLVED
@@ -0,0 +1,30 @@
+from collections import OrderedDict
+
+
+class PageCache:
+    """LRU cache of rendered leaderboard pages.
+
+    Keys include the version of the ranking index a page was rendered from, so
+    stale pages are never served; they simply age out.
+    """
+
+    def __init__(self, max_pages=5000):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        page = self._pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
@@ -0,0 +1,197 @@
+import itertools
+import time
+
+import numpy as np
+from sortedcontainers import SortedList
+
+from activity import HOUR, HOUR_SLOTS, MINUTE, MINUTE_SLOTS
+
+# Leaderboard timeframes and their window length in seconds (0 = all time)
+TIMEFRAMES = {"1h": 3600, "1d": 86400, "24h": 86400, "7d": 604800, "14d": 1209600, "all": 0}
+
+USERS_PER_CHUNK = 4096  # histograms stacked into one array when windows are built
+
+# Every index state gets a process-wide unique version, so rendered pages can be cached by it.
+_versions = itertools.count(1)
+
+
+class RankingIndex:
+    """Order-statistic index of message counts: users ordered by count (highest
+    first, ties by numeric user ID), with O(log n) updates, rank lookups and page slices."""
+
+    def __init__(self, counts=None):
+        self.version = next(_versions)
+        self._counts = {}
+        self._order = SortedList()
+        self.total = 0
+        if counts:
+            self._counts = {uid: n for uid, n in counts.items() if n > 0}
+            self._order = SortedList((-n, int(uid)) for uid, n in self._counts.items())
+            self.total = sum(self._counts.values())
+
+    def __len__(self):
+        return len(self._order)
+
+    def increment(self, user_id, n=1):
+        """Adds n to a user's count; n may be negative, and users at zero drop out."""
+        old = self._counts.get(user_id, 0)
+        if old:
+            self._order.remove((-old, int(user_id)))
+        new = max(old + n, 0)
+        if new:
+            self._counts[user_id] = new
+            self._order.add((-new, int(user_id)))
+        else:
+            self._counts.pop(user_id, None)
+        self.total += new - old
+        self.version = next(_versions)
+
+    def count(self, user_id):
+        return self._counts.get(user_id, 0)
+
+    def rank(self, user_id):
+        """Returns the user's 1-based position, or None if they have no messages."""
+        n = self._counts.get(user_id)
+        if not n:
+            return None
+        return self._order.index((-n, int(user_id))) + 1
+
+    def page(self, start, stop):
+        """Returns [(user_id, count), ...] for positions start..stop-1 (0-based)."""
+        return [(str(uid), -neg) for neg, uid in self._order.islice(start, stop)]
+
+
+class GuildRankings:
+    """Per-guild ranking indexes for all time and every leaderboard timeframe.
+
+    All indexes are maintained incrementally. Windowed indexes also keep the
+    messages of their window as {bucket: {user_id: count}}, per minute for the
+    last hour and per hour beyond; when a bucket ages out of a window, its
+    counts are subtracted from that window's index. The buckets and indexes of
+    one resolution are built from the activity histograms on its first query.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._all = RankingIndex(data["counts"])
+        self._buckets = {}      # resolution seconds -> {bucket: {user_id: count}}
+        self._kept = {}         # resolution seconds -> oldest bucket any window still counts
+        self._windows = {}      # window seconds -> [first bucket counted, RankingIndex]
+        self._roles = {}        # role id -> (membership version, member ID set, RankingIndex)
+
+    def record(self, user_id, n=1, ts=None):
+        """Counts n messages sent by a user at Unix time ts (default: now)."""
+        self._all.increment(user_id, n)
+        if self._buckets:
+            ts = time.time() if ts is None else ts
+            for resolution, buckets in self._buckets.items():
+                bucket = int(ts // resolution)
+                if bucket >= self._kept[resolution]:
+                    users = buckets.setdefault(bucket, {})
+                    users[user_id] = users.get(user_id, 0) + n
+            for seconds, (first, index) in self._windows.items():
+                if int(ts // _resolution(seconds)) >= first:
+                    index.increment(user_id, n)
+        for _, members, index in self._roles.values():
+            if user_id in members:
+                index.increment(user_id, n)
+
+    def get(self, timeframe, now=None):
+        seconds = TIMEFRAMES[timeframe]
+        if not seconds:
+            return self._all
+        now = time.time() if now is None else now
+        if _resolution(seconds) not in self._buckets:
+            self._build_windows(_resolution(seconds), now)
+        self._advance_windows(now)
+        return self._windows[seconds][1]
+
+    def _build_windows(self, resolution, now):
+        """Builds the buckets and the indexes of every window tracked at one resolution."""
+        windows = sorted({s for s in TIMEFRAMES.values() if s and _resolution(s) == resolution})
+        firsts = [int((now - s) // resolution) for s in windows]
+        self._buckets[resolution], counts = _bucket_activity(self._data["activity"], resolution, firsts)
+        self._kept[resolution] = min(firsts)
+        for seconds, first, window_counts in zip(windows, firsts, counts):
+            self._windows[seconds] = [first, RankingIndex(window_counts)]
+
+    def _advance_windows(self, now):
+        """Subtracts the buckets that have aged out of each window since the last query."""
+        for seconds, window in self._windows.items():
+            resolution = _resolution(seconds)
+            first = int((now - seconds) // resolution)
+            if first <= window[0]:
+                continue
+            buckets = self._buckets[resolution]
+            for bucket in [b for b in buckets if window[0] <= b < first]:
+                for user_id, count in buckets[bucket].items():
+                    window[1].increment(user_id, -count)
+            window[0] = first
+        for resolution, buckets in self._buckets.items():
+            kept = min(first for seconds, (first, _) in self._windows.items() if _resolution(seconds) == resolution)
+            if kept > self._kept[resolution]:
+                for bucket in [b for b in buckets if b < kept]:
+                    del buckets[bucket]
+                self._kept[resolution] = kept
+
+    def get_role(self, role_id, members, membership_version):
+        """Returns the all-time index restricted to one role's members.
+
+        `members` is the role's live member ID set (see RoleIndex); the index
+        follows new messages incrementally and is rebuilt only when the role's
+        membership version changes.
+        """
+        built = self._roles.get(role_id)
+        if built is None or built[0] != membership_version:
+            counts = {uid: self._all.count(uid) for uid in members}
+            built = self._roles[role_id] = (membership_version, members, RankingIndex(counts))
+        return built[2]
+
+    def forget_role(self, role_id):
+        self._roles.pop(role_id, None)
+
+
+def _bucket_activity(activity, resolution, firsts):
+    """Splits the activity histograms into {bucket: {user_id: count}} at one
+    resolution, from min(firsts) on, and sums every user's messages from each
+    bucket in `firsts`. Returns (buckets, [{user_id: count} per first]).
+
+    The rings are stacked into 2-D NumPy arrays USERS_PER_CHUNK users at a time,
+    as in analytics, so only the non-empty buckets are touched from Python.
+    """
+    ring_name, head_name, slots = ("minutes", "minute_head", MINUTE_SLOTS) if resolution == MINUTE else ("hours", "hour_head", HOUR_SLOTS)
+    user_ids = [uid for uid, hist in activity.items() if getattr(hist, ring_name) is not None]
+    buckets = {}
+    counts = [{} for _ in firsts]
+    for start in range(0, len(user_ids), USERS_PER_CHUNK):
+        chunk = np.array(user_ids[start:start + USERS_PER_CHUNK], dtype=object)
+        hists = [activity[uid] for uid in chunk]
+        rings = np.frombuffer(b"".join(getattr(h, ring_name).tobytes() for h in hists), dtype=np.uint32).reshape(len(hists), slots)
+        heads = np.fromiter((getattr(h, head_name) for h in hists), dtype=np.int64, count=len(hists))
+        rows, cols = np.nonzero(rings)
+        # Absolute bucket held by each non-empty slot.
+        bucket_of = heads[rows] - ((heads[rows] - cols) % slots)
+        n = rings[rows, cols].astype(np.int64)
+        kept = bucket_of >= min(firsts)
+        rows, bucket_of, n = rows[kept], bucket_of[kept], n[kept]
+        for window_counts, first in zip(counts, firsts):
+            totals = np.bincount(rows, weights=np.where(bucket_of >= first, n, 0), minlength=len(hists)).astype(np.int64)
+            users = np.nonzero(totals)[0]
+            window_counts.update(zip(chunk[users].tolist(), totals[users].tolist()))
+        order = np.argsort(bucket_of, kind="stable")
+        values, starts = np.unique(bucket_of[order], return_index=True)
+        bucket_users, n = chunk[rows[order]].tolist(), n[order].tolist()
+        for bucket, lo, hi in zip(values.tolist(), starts.tolist(), starts[1:].tolist() + [len(n)]):
+            buckets.setdefault(bucket, {}).update(zip(bucket_users[lo:hi], n[lo:hi]))
+    return buckets, counts
+
+def _resolution(seconds):
+    """Bucket size a window is tracked at: minutes for the last hour, hours beyond."""
+    return MINUTE if seconds <= HOUR else HOUR
+
+def get_rankings(data):
+    """Returns the ranking indexes attached to a guild's cached data, building them on first use."""
+    rankings = data.get("rankings")
+    if rankings is None:
+        rankings = data["rankings"] = GuildRankings(data)
+    return rankings
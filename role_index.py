@@ -0,0 +1,115 @@
+import itertools
+
+MAX_CACHED_LOOKUPS = 1000
+# Each index gets a process-wide unique generation, so membership versions from a
+# rebuilt index never collide with those of the index it replaced.
+_generations = itertools.count(1)
+
+
+def normalize_role_name(name):
+    return name.strip().lower()
+
+
+class RoleIndex:
+    """Per-guild index of role membership and role names.
+
+    Built once from the member cache, then kept current by member and role
+    events, so role lookups are dict hits and role leaderboards only touch the
+    members of that role.
+    """
+
+    def __init__(self, guild):
+        self.generation = next(_generations)
+        self.roles = {}         # role id -> Role
+        self.members = {}       # role id -> set of member IDs (as strings)
+        self.versions = {}      # role id -> membership version
+        self._names = {}        # normalized name -> [Role, ...]
+        self._lookups = {}      # normalized query -> Role or None, for substring matches
+        for role in guild.roles:
+            self.add_role(role)
+        for member in guild.members:
+            self.add_member(member)
+
+    # ---- roles ----
+    def add_role(self, role):
+        self.roles[role.id] = role
+        self.members.setdefault(role.id, set())
+        self.versions[role.id] = self.versions.get(role.id, 0) + 1
+        self._names.setdefault(normalize_role_name(role.name), []).append(role)
+        self._lookups.clear()
+
+    def remove_role(self, role):
+        old = self.roles.pop(role.id, None)
+        self.members.pop(role.id, None)
+        self.versions.pop(role.id, None)
+        if old is not None:
+            self._forget_name(old)
+        self._lookups.clear()
+
+    def update_role(self, before, after):
+        old = self.roles.get(after.id, before)
+        self._forget_name(old)
+        self.roles[after.id] = after
+        self._names.setdefault(normalize_role_name(after.name), []).append(after)
+        self._lookups.clear()
+
+    def _forget_name(self, role):
+        name = normalize_role_name(role.name)
+        same_name = [r for r in self._names.get(name, []) if r.id != role.id]
+        if same_name:
+            self._names[name] = same_name
+        else:
+            self._names.pop(name, None)
+
+    def membership_version(self, role_id):
+        """A key that changes whenever the role's members change, across rebuilds too."""
+        return self.generation, self.versions.get(role_id, 0)
+
+    # ---- members ----
+    def _add_to(self, role_id, member_id):
+        members = self.members.setdefault(role_id, set())
+        if member_id not in members:
+            members.add(member_id)
+            self.versions[role_id] = self.versions.get(role_id, 0) + 1
+
+    def _remove_from(self, role_id, member_id):
+        members = self.members.get(role_id)
+        if members and member_id in members:
+            members.discard(member_id)
+            self.versions[role_id] = self.versions.get(role_id, 0) + 1
+
+    def add_member(self, member):
+        member_id = str(member.id)
+        for role in member.roles:
+            self._add_to(role.id, member_id)
+
+    def remove_member(self, member):
+        member_id = str(member.id)
+        for role in member.roles:
+            self._remove_from(role.id, member_id)
+
+    def update_member(self, before, after):
+        member_id = str(after.id)
+        old = {r.id for r in before.roles}
+        new = {r.id for r in after.roles}
+        for role_id in old - new:
+            self._remove_from(role_id, member_id)
+        for role_id in new - old:
+            self._add_to(role_id, member_id)
+
+    # ---- lookups ----
+    def find(self, query):
+        """Resolves a role name: exact (case-insensitive) match first, then a
+        unique substring match, else the highest substring match."""
+        s = normalize_role_name(query)
+        exact = self._names.get(s)
+        if exact:
+            return min(exact, key=lambda r: r.position)
+        if s in self._lookups:
+            return self._lookups[s]
+        matches = [r for r in self.roles.values() if s in normalize_role_name(r.name)]
+        role = max(matches, key=lambda r: r.position) if matches else None
+        if len(self._lookups) >= MAX_CACHED_LOOKUPS:
+            self._lookups.clear()
+        self._lookups[s] = role
+        return role
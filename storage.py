@@ -0,0 +1,728 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from activity import ActivityHistogram, HOUR, HOUR_SLOTS, MINUTE, MINUTE_SLOTS
+from compaction import DAY, EVENT_RETENTION, add_rollup
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COUNTS_PATTERN = re.compile(r'message_counts_(\d+)\.json$')
+GUILD_CONFIG_PATTERN = re.compile(r'guild_config_(\d+)\.json$')
+TIMERS_FILE = 'timers.jsonl'
+JSON_SEPARATORS = (',', ':')     # guild files are written without whitespace
+
+
+# ---------------------- JSON FILES ----------------------
+def get_message_counts_file(guild_id, directory='.'):
+    """Returns the file path for a specific guild's message counts."""
+    return os.path.join(directory, f'message_counts_{guild_id}.json')
+
+def default_message_counts():
+    return {"counts": {}, "activity": {}, "last_reset": int(time.time())}
+
+def normalize_message_counts(data):
+    """Fills in missing keys and converts stored activity into ActivityHistogram objects.
+
+    Older files kept a raw list of timestamps per user under "timestamps"; those
+    are folded into histograms and the list is dropped.
+    """
+    data.setdefault("counts", {})
+    data.setdefault("last_reset", int(time.time()))
+    activity = {uid: ActivityHistogram.from_dict(hist) for uid, hist in data.get("activity", {}).items()}
+    if "daily" in data:
+        # Daily rollups are stored as [[day, count], ...] per user; days count from the Unix epoch.
+        data["daily"] = {uid: {int(day): n for day, n in days} for uid, days in data["daily"].items()}
+    legacy = data.pop("timestamps", {})
+    if legacy:
+        # Timestamps too old for the hourly ring go straight into daily rollups, as compaction would.
+        threshold = time.time() - EVENT_RETENTION
+        daily = data.setdefault("daily", {})
+        for uid, ts in legacy.items():
+            if not isinstance(ts, list):
+                ts = [float(ts)] if ts else []
+            recent = []
+            for t in ts:
+                if float(t) < threshold:
+                    add_rollup(daily, uid, float(t), 1)
+                else:
+                    recent.append(t)
+            if recent:
+                activity[uid] = ActivityHistogram.from_timestamps(recent)
+        if not daily:
+            del data["daily"]
+    data["activity"] = activity
+    return data
+
+def load_message_counts(guild_id, directory='.'):
+    """Loads message counts from a file specific to a guild."""
+    file_path = get_message_counts_file(guild_id, directory)
+    default_data = default_message_counts()
+    if not os.path.exists(file_path):
+        save_message_counts(guild_id, default_data, directory)
+        return default_data
+    try:
+        with open(file_path, 'r') as f:
+            return normalize_message_counts(json.load(f))
+    except Exception as e:
+        logger.error(f"Error loading {file_path}: {e}")
+        save_message_counts(guild_id, default_data, directory)
+        return default_data
+
+def save_message_counts(guild_id, data, directory='.'):
+    """Saves message counts to a file specific to a guild."""
+    file_path = get_message_counts_file(guild_id, directory)
+    try:
+        temp_file = file_path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, separators=JSON_SEPARATORS)
+        os.replace(temp_file, file_path)
+    except Exception as e:
+        logger.error(f"Error saving message counts for guild {guild_id}: {e}")
+
+def snapshot_message_counts(data):
+    """Copies in-memory guild data cheaply enough to do on the event loop: histograms
+    are copied array by array, to be serialized later in a worker thread."""
+    snapshot = {
+        "counts": dict(data.get("counts", {})),
+        "activity": {uid: hist.copy() for uid, hist in data.get("activity", {}).items()},
+        "last_reset": data.get("last_reset"),
+    }
+    if data.get("daily"):
+        snapshot["daily"] = {uid: dict(days) for uid, days in data["daily"].items()}
+    if data.get("backfill"):
+        snapshot["backfill"] = json.loads(json.dumps(data["backfill"]))
+    return snapshot
+
+def serialize_message_counts(data):
+    """Converts in-memory guild data (with histogram objects) into its JSON form."""
+    serialized = {
+        "counts": dict(data.get("counts", {})),
+        "activity": {uid: hist.to_dict() for uid, hist in data.get("activity", {}).items()},
+        "last_reset": data.get("last_reset"),
+    }
+    if data.get("daily"):
+        serialized["daily"] = {uid: sorted(days.items()) for uid, days in data["daily"].items()}
+    if data.get("backfill"):
+        # Copied, since a running backfill keeps updating its checkpoints.
+        serialized["backfill"] = json.loads(json.dumps(data["backfill"]))
+    return serialized
+
+
+class JsonStorage:
+    """The original layout: one message_counts_<guild_id>.json file per guild.
+
+    Individual messages are not persisted on their own; the guild cache writes
+    whole-guild snapshots through `save_guild`.
+    """
+
+    persists_increments = False
+
+    def __init__(self, directory='.', timers_file=TIMERS_FILE):
+        self.directory = directory
+        self.timers_file = timers_file
+        self.bytes_written = 0
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def load_guild(self, guild_id):
+        return load_message_counts(guild_id, self.directory)
+
+    def save_guild(self, guild_id, data):
+        save_message_counts(guild_id, data, self.directory)
+        try:
+            self.bytes_written += os.path.getsize(get_message_counts_file(guild_id, self.directory))
+        except OSError:
+            pass
+
+    def record_message(self, guild_id, user_id, ts):
+        pass
+
+    # Timers are kept in an append-only journal of add/remove records, compacted on load.
+    def load_timers(self):
+        timers = {}
+        path = os.path.join(self.directory, self.timers_file)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("op") == "add":
+                        timers[record["timer"]["id"]] = record["timer"]
+                    else:
+                        timers.pop(record.get("id"), None)
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.writelines(json.dumps({"op": "add", "timer": t}) + "\n" for t in timers.values())
+        os.replace(temp_file, path)
+        return list(timers.values())
+
+    def _append_timer_record(self, record):
+        try:
+            with open(os.path.join(self.directory, self.timers_file), 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            logger.error(f"Error saving timer: {e}")
+
+    def add_timer(self, timer):
+        self._append_timer_record({"op": "add", "timer": timer})
+
+    def remove_timer(self, timer_id):
+        self._append_timer_record({"op": "remove", "id": timer_id})
+
+    # Export streams, matching SqliteStorage's. They read the guild file as stored
+    # (never creating it) and build one user's histogram at a time.
+    def _read_stored(self, guild_id):
+        """Returns a guild's file as stored, or None if it has none or it can't be read."""
+        file_path = get_message_counts_file(guild_id, self.directory)
+        try:
+            with open(file_path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading {file_path}: {e}")
+            return None
+        if "timestamps" in data:
+            data = serialize_message_counts(normalize_message_counts(data))
+        return data
+
+    def iter_counts(self, guild_id):
+        counts = (self._read_stored(guild_id) or {}).get("counts", {})
+        for user_id in sorted(counts, key=int):
+            yield int(user_id), counts[user_id]
+
+    def iter_window_counts(self, guild_id, thresholds):
+        """Yields (user_id, n_since_threshold_1, ...) for every user with events since min(thresholds)."""
+        activity = (self._read_stored(guild_id) or {}).get("activity", {})
+        for user_id in sorted(activity, key=int):
+            hist = ActivityHistogram.from_dict(activity[user_id])
+            row = [hist.count_since(t) for t in thresholds]
+            if any(row):
+                yield (int(user_id), *row)
+
+    def iter_daily(self, guild_id):
+        """Yields (user_id, day, messages) from the daily rollups and the hourly activity combined."""
+        data = self._read_stored(guild_id) or {}
+        daily = data.get("daily", {})
+        activity = data.get("activity", {})
+        for user_id in sorted(daily.keys() | activity.keys(), key=int):
+            days = {}
+            for day, n in daily.get(user_id, ()):
+                days[day] = days.get(day, 0) + n
+            if user_id in activity:
+                for start, count in ActivityHistogram.from_dict(activity[user_id]).hour_buckets():
+                    days[start // DAY] = days.get(start // DAY, 0) + count
+            for day in sorted(days):
+                yield int(user_id), day, days[day]
+
+    def guild_version(self, guild_id):
+        """Changes whenever a guild's file is rewritten (its modification time)."""
+        try:
+            return os.stat(get_message_counts_file(guild_id, self.directory)).st_mtime_ns
+        except OSError:
+            return None
+
+    def guild_ids(self):
+        paths = glob.glob(os.path.join(self.directory, 'message_counts_*.json'))
+        return [m.group(1) for m in map(MESSAGE_COUNTS_PATTERN.search, paths) if m]
+
+    # Guild configs live in guild_config_<guild_id>.json, next to the counts.
+    def load_configs(self):
+        configs = {}
+        for path in glob.glob(os.path.join(self.directory, 'guild_config_*.json')):
+            match = GUILD_CONFIG_PATTERN.search(path)
+            if not match:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    configs[match.group(1)] = json.load(f)
+            except Exception as e:
+                logger.error(f"Error loading {path}: {e}")
+        return configs
+
+    def save_config(self, guild_id, config):
+        """Atomically replaces a guild's config file. Raises if it can't be written."""
+        path = os.path.join(self.directory, f'guild_config_{guild_id}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(config, f, indent=4)
+        os.replace(path + '.tmp', path)
+
+
+# ---------------------- SQLITE ----------------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    last_reset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counts (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    n INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS timers (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    channel_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    created REAL NOT NULL,
+    deadline REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, day, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guild_config (
+    guild_id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill (
+    guild_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_guild_ts ON events (guild_id, ts);
+CREATE INDEX IF NOT EXISTS counts_guild_count ON counts (guild_id, count DESC);
+"""
+
+
+# Timer writes share the writer queue; they are tracked under this pseudo guild key.
+TIMER_QUEUE_KEY = 'timers'
+WRITE_WAIT_TIMEOUT = 10     # seconds a read waits for the writer queue before going ahead without it
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class SqliteStorage:
+    """SQLite (WAL) storage shared by all guilds.
+
+    Message increments are queued and group-committed by a background writer
+    thread, so callers on the event loop never wait on disk. Whole-guild writes
+    (resets, imports) go through the same queue to keep them ordered with the
+    increments queued before them.
+
+    Several bot processes (see cluster.py) can share one database: increments
+    are additive upserts, a guild's events only ever reach the process running
+    its shard, and WAL lets readers in other processes carry on during commits.
+    """
+
+    persists_increments = True
+
+    def __init__(self, path='strack.db', batch_size=5000, batch_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._queue = queue.Queue()
+        self._pending = {}      # guild_id -> queued operations not yet committed
+        self._pending_lock = threading.Condition()
+        self._writer = None
+        self._local = threading.local()
+        self.committed_batches = 0
+        self.committed_increments = 0
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        # sqlite3 connections are bound to the thread that made them.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run_writer, name='strack-sqlite-writer', daemon=True)
+            self._writer.start()
+
+    def close(self):
+        """Commits everything still queued and stops the writer."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        else:
+            # Never started (e.g. offline tools): commit inline.
+            self._queue.put(None)
+            self._run_writer()
+
+    def _enqueue(self, guild_id, op):
+        with self._pending_lock:
+            self._pending[guild_id] = self._pending.get(guild_id, 0) + 1
+        self._queue.put((guild_id, op))
+
+    def record_message(self, guild_id, user_id, ts):
+        self._enqueue(guild_id, ("inc", user_id, int(ts), 1))
+
+    def record_messages(self, guild_id, rows, checkpoint=None):
+        """Queues a bulk batch of (user_id, ts, n) increments for one guild.
+        A backfill `checkpoint` is committed in the same transaction as the rows."""
+        self._enqueue(guild_id, ("bulk", rows, checkpoint))
+
+    def save_guild(self, guild_id, data):
+        self._enqueue(guild_id, ("replace", data))
+
+    def add_timer(self, timer):
+        self._enqueue(TIMER_QUEUE_KEY, ("timer_add", timer))
+
+    def remove_timer(self, timer_id):
+        self._enqueue(TIMER_QUEUE_KEY, ("timer_remove", timer_id))
+
+    def load_configs(self):
+        return {str(g): json.loads(config) for g, config in self._reader().execute("SELECT guild_id, config FROM guild_config")}
+
+    def save_config(self, guild_id, config):
+        """Queues a guild's config and waits until it is committed."""
+        self._enqueue(guild_id, ("config", config))
+        if not self.wait_for_guild(guild_id):
+            raise TimeoutError(f"Config for guild {guild_id} was not committed in time")
+
+    def load_timers(self):
+        self.wait_for_guild(TIMER_QUEUE_KEY)
+        rows = self._reader().execute("SELECT id, guild_id, channel_id, user_id, created, deadline FROM timers")
+        return [{"id": i, "guild_id": str(g) if g is not None else None, "channel_id": c, "user_id": u,
+                 "created": created, "deadline": deadline} for i, g, c, u, created, deadline in rows]
+
+    def wait_for_guild(self, guild_id, timeout=WRITE_WAIT_TIMEOUT):
+        """Blocks until every queued write for a guild has been committed, or
+        `timeout` seconds have passed. Returns whether the writes made it."""
+        if self._writer is None or not self._pending.get(guild_id):
+            return not self._pending.get(guild_id)
+        if _on_event_loop():
+            # Blocking here would stall the bot; callers on the loop go through a worker thread.
+            logger.warning(f"Not waiting for queued writes of {guild_id} on the event loop; reading without them")
+            return False
+        with self._pending_lock:
+            committed = self._pending_lock.wait_for(lambda: not self._pending.get(guild_id), timeout)
+        if not committed:
+            logger.warning(f"Gave up waiting {timeout}s for queued writes of {guild_id}; reading without them")
+        return committed
+
+    def _run_writer(self):
+        conn = self._connect()
+        running = True
+        while running:
+            item = self._queue.get()
+            batch = []
+            deadline = time.monotonic() + self.batch_interval
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            if batch:
+                self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        try:
+            self._apply_batch(conn, batch)
+        except Exception as e:
+            # One bad op must not cost the rest of the batch; retry them one by one.
+            logger.error(f"Error committing {len(batch)} queued write(s) to {self.path}: {e}")
+            if len(batch) > 1:
+                for item in batch:
+                    try:
+                        self._apply_batch(conn, [item])
+                    except Exception as e:
+                        logger.error(f"Dropping queued {item[1][0]} write for guild {item[0]}: {e}")
+        finally:
+            # Every op taken off the queue is settled now, committed or not.
+            with self._pending_lock:
+                for guild_id, _ in batch:
+                    left = self._pending.get(guild_id, 0) - 1
+                    if left > 0:
+                        self._pending[guild_id] = left
+                    else:
+                        self._pending.pop(guild_id, None)
+                self._pending_lock.notify_all()
+
+    def _apply_batch(self, conn, batch):
+        """Applies queued ops in a single transaction; raises (after rolling back) if any op fails."""
+        counts = {}
+        events = {}
+        seen = set()
+        increments = 0
+
+        def apply_increments():
+            nonlocal increments
+            if counts:
+                conn.executemany(
+                    "INSERT INTO counts (guild_id, user_id, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT (guild_id, user_id) DO UPDATE SET count = count + excluded.count",
+                    [(g, u, n) for (g, u), n in counts.items()])
+                conn.executemany("INSERT INTO events (guild_id, user_id, ts, n) VALUES (?, ?, ?, ?)",
+                                 [(g, u, ts, n) for (g, u, ts), n in events.items()])
+                increments += sum(counts.values())
+                counts.clear()
+                events.clear()
+
+        with conn:
+            for guild_id, op in batch:
+                if op[0] in ("timer_add", "timer_remove"):
+                    self._write_timer(conn, op)
+                    continue
+                g = int(guild_id)
+                if op[0] == "create":
+                    # Stores the last_reset load_guild handed out for a new guild.
+                    conn.execute("INSERT OR IGNORE INTO guilds (guild_id, last_reset) VALUES (?, ?)", (g, op[1]))
+                    seen.add(guild_id)
+                    continue
+                if guild_id not in seen:
+                    conn.execute("INSERT OR IGNORE INTO guilds (guild_id, last_reset) VALUES (?, ?)",
+                                 (g, int(time.time())))
+                    seen.add(guild_id)
+                if op[0] == "inc":
+                    _, user_id, ts, n = op
+                    key = (g, int(user_id))
+                    counts[key] = counts.get(key, 0) + n
+                    events[(g, int(user_id), ts)] = events.get((g, int(user_id), ts), 0) + n
+                elif op[0] == "bulk":
+                    for user_id, ts, n in op[1]:
+                        key = (g, int(user_id))
+                        counts[key] = counts.get(key, 0) + n
+                        events[(g, int(user_id), int(ts))] = events.get((g, int(user_id), int(ts)), 0) + n
+                    if op[2] is not None:
+                        conn.execute("INSERT OR REPLACE INTO backfill (guild_id, state) VALUES (?, ?)",
+                                     (g, json.dumps(op[2])))
+                elif op[0] == "config":
+                    conn.execute("INSERT OR REPLACE INTO guild_config (guild_id, config) VALUES (?, ?)",
+                                 (g, json.dumps(op[1])))
+                elif op[0] == "replace":
+                    # Flush increments queued before the replace so ordering is kept.
+                    apply_increments()
+                    self._replace_guild(conn, g, op[1])
+            apply_increments()
+        self.committed_batches += 1
+        self.committed_increments += increments
+
+    def _write_timer(self, conn, op):
+        if op[0] == "timer_add":
+            t = op[1]
+            conn.execute("INSERT OR REPLACE INTO timers (id, guild_id, channel_id, user_id, created, deadline) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (t["id"], int(t["guild_id"]) if t["guild_id"] else None, t["channel_id"], t["user_id"],
+                          t["created"], t["deadline"]))
+        else:
+            conn.execute("DELETE FROM timers WHERE id = ?", (op[1],))
+
+    def _replace_guild(self, conn, g, data):
+        conn.execute("DELETE FROM counts WHERE guild_id = ?", (g,))
+        conn.execute("DELETE FROM events WHERE guild_id = ?", (g,))
+        conn.execute("DELETE FROM backfill WHERE guild_id = ?", (g,))
+        conn.execute("DELETE FROM daily_rollups WHERE guild_id = ?", (g,))
+        conn.executemany("INSERT INTO daily_rollups (guild_id, user_id, day, n) VALUES (?, ?, ?, ?)",
+                         [(g, int(uid), int(day), n) for uid, days in data.get("daily", {}).items()
+                          for day, n in (days.items() if isinstance(days, dict) else days)])
+        if data.get("backfill"):
+            conn.execute("INSERT INTO backfill (guild_id, state) VALUES (?, ?)", (g, json.dumps(data["backfill"])))
+        conn.execute("INSERT OR REPLACE INTO guilds (guild_id, last_reset) VALUES (?, ?)",
+                     (g, int(data.get("last_reset") or time.time())))
+        conn.executemany("INSERT INTO counts (guild_id, user_id, count) VALUES (?, ?, ?)",
+                         [(g, int(uid), int(n)) for uid, n in data.get("counts", {}).items()])
+        activity = data.get("activity", {})
+        rows = []
+        for uid, hist in activity.items():
+            if isinstance(hist, dict):
+                hist = ActivityHistogram.from_dict(hist)
+            rows.extend((g, int(uid), int(ts), n) for ts, n in hist.events())
+        conn.executemany("INSERT INTO events (guild_id, user_id, ts, n) VALUES (?, ?, ?, ?)", rows)
+
+    def load_guild(self, guild_id, now=None):
+        # A guild reloaded after eviction must see the increments still in the writer queue.
+        self.wait_for_guild(guild_id)
+        g = int(guild_id)
+        conn = self._reader()
+        row = conn.execute("SELECT last_reset FROM guilds WHERE guild_id = ?", (g,)).fetchone()
+        if row is None:
+            # Store the same last_reset that is handed out, so state keyed on it
+            # (e.g. backfill checkpoints) still matches after a reload.
+            data = default_message_counts()
+            self._enqueue(guild_id, ("create", data["last_reset"]))
+            return data
+        counts = {str(uid): n for uid, n in conn.execute("SELECT user_id, count FROM counts WHERE guild_id = ?", (g,))}
+        # Histograms are built from per-bucket sums, so SQLite does the aggregation.
+        now = int(now or time.time())
+        hours = {}
+        for uid, hour, n in conn.execute(
+                "SELECT user_id, ts / ?, SUM(n) FROM events WHERE guild_id = ? AND ts >= ? GROUP BY user_id, ts / ?",
+                (HOUR, g, now - HOUR_SLOTS * HOUR, HOUR)):
+            hours.setdefault(uid, []).append((hour, n))
+        # A minute ring covers the hour before a user's newest message, so minutes are
+        # needed for two hours back; users with none get an empty ring ending now.
+        minutes = {}
+        for uid, minute, n in conn.execute(
+                "SELECT user_id, ts / ?, SUM(n) FROM events WHERE guild_id = ? AND ts >= ? GROUP BY user_id, ts / ?",
+                (MINUTE, g, now - 2 * MINUTE_SLOTS * MINUTE, MINUTE)):
+            minutes.setdefault(uid, []).append((minute, n))
+        activity = {str(uid): ActivityHistogram.from_buckets(pairs, minutes.get(uid), now // MINUTE)
+                    for uid, pairs in hours.items()}
+        data = {"counts": counts, "activity": activity, "last_reset": row[0]}
+        backfill = conn.execute("SELECT state FROM backfill WHERE guild_id = ?", (g,)).fetchone()
+        if backfill:
+            data["backfill"] = json.loads(backfill[0])
+        return data
+
+    def guild_ids(self):
+        return [str(g) for (g,) in self._reader().execute("SELECT guild_id FROM guilds")]
+
+    def load_rollups(self, guild_id, events_before=None):
+        """Returns a guild's daily rollups as {user_id: {day: messages}}. With
+        `events_before`, raw events older than that are rolled in as well."""
+        self.wait_for_guild(str(guild_id))
+        g = int(guild_id)
+        query = "SELECT user_id, day, n FROM daily_rollups WHERE guild_id = ?"
+        params = [g]
+        if events_before is not None:
+            query = ("SELECT user_id, day, SUM(n) FROM (" + query +
+                     " UNION ALL SELECT user_id, ts / 86400, n FROM events WHERE guild_id = ? AND ts < ?"
+                     ") GROUP BY user_id, day")
+            params += [g, int(events_before)]
+        daily = {}
+        for uid, day, n in self._reader().execute(query, params):
+            daily.setdefault(str(uid), {})[day] = n
+        return daily
+
+    def daily_totals(self, guild_id, first_day, user_id=None):
+        """Returns [(day, messages), ...] from the daily rollups, for one user or the whole guild."""
+        query = "SELECT day, SUM(n) FROM daily_rollups WHERE guild_id = ? AND day >= ?"
+        params = [int(guild_id), first_day]
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(int(user_id))
+        return self._reader().execute(query + " GROUP BY day", params).fetchall()
+
+    # Export streams: rows come straight off a cursor, ordered by user, so a
+    # guild's data is never materialized as a whole.
+    def iter_counts(self, guild_id):
+        self.wait_for_guild(str(guild_id))
+        yield from self._reader().execute(
+            "SELECT user_id, count FROM counts WHERE guild_id = ? ORDER BY user_id", (int(guild_id),))
+
+    def iter_window_counts(self, guild_id, thresholds):
+        """Yields (user_id, n_since_threshold_1, ...) for every user with events since min(thresholds)."""
+        self.wait_for_guild(str(guild_id))
+        columns = ", ".join("SUM(CASE WHEN ts >= ? THEN n ELSE 0 END)" for _ in thresholds)
+        yield from self._reader().execute(
+            f"SELECT user_id, {columns} FROM events WHERE guild_id = ? AND ts >= ? GROUP BY user_id ORDER BY user_id",
+            (*thresholds, int(guild_id), min(thresholds)))
+
+    def iter_daily(self, guild_id):
+        """Yields (user_id, day, messages) from the daily rollups and the raw events combined."""
+        self.wait_for_guild(str(guild_id))
+        g = int(guild_id)
+        yield from self._reader().execute(
+            "SELECT user_id, day, SUM(n) FROM ("
+            " SELECT user_id, day, n FROM daily_rollups WHERE guild_id = ?"
+            " UNION ALL SELECT user_id, ts / 86400, n FROM events WHERE guild_id = ?"
+            ") GROUP BY user_id, day ORDER BY user_id, day", (g, g))
+
+    def compact(self, guild_id, before, rollup_before_day=None, slice_seconds=30 * 86400):
+        """Folds a guild's events older than `before` into daily per-user rollups and
+        deletes rollup days before `rollup_before_day`. Counts are left untouched.
+
+        Runs on the calling thread in transactions of at most `slice_seconds` of
+        events each, so the writer thread is never locked out for long.
+        Returns (events deleted, rollup rows deleted).
+        """
+        g = int(guild_id)
+        conn = self._reader()
+        events_deleted = 0
+        oldest = conn.execute("SELECT MIN(ts) FROM events WHERE guild_id = ?", (g,)).fetchone()[0]
+        start = oldest
+        while start is not None and start < before:
+            stop = min(before, start + slice_seconds)
+            with conn:
+                conn.execute(
+                    "INSERT INTO daily_rollups (guild_id, user_id, day, n) "
+                    "SELECT guild_id, user_id, ts / 86400, SUM(n) FROM events "
+                    "WHERE guild_id = ? AND ts >= ? AND ts < ? GROUP BY user_id, ts / 86400 "
+                    "ON CONFLICT (guild_id, day, user_id) DO UPDATE SET n = n + excluded.n",
+                    (g, start, stop))
+                events_deleted += conn.execute("DELETE FROM events WHERE guild_id = ? AND ts >= ? AND ts < ?",
+                                               (g, start, stop)).rowcount
+            start = stop
+        rollups_deleted = 0
+        if rollup_before_day is not None:
+            with conn:
+                rollups_deleted = conn.execute("DELETE FROM daily_rollups WHERE guild_id = ? AND day < ?",
+                                               (g, rollup_before_day)).rowcount
+        return events_deleted, rollups_deleted
+
+
+def create_storage(backend='json', **options):
+    """Builds the storage backend named by STORAGE_BACKEND ('json' or 'sqlite')."""
+    if backend == 'sqlite':
+        return SqliteStorage(options.get('path', 'strack.db'))
+    if backend == 'json':
+        return JsonStorage(options.get('directory', '.'), options.get('timers_file', TIMERS_FILE))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def import_json_files(target, directory='.'):
+    """One-shot import of every message_counts_<guild_id>.json file into `target`."""
+    source = JsonStorage(directory)
+    imported = 0
+    for guild_id in source.guild_ids():
+        try:
+            with open(get_message_counts_file(guild_id, directory), 'r') as f:
+                data = normalize_message_counts(json.load(f))
+        except Exception as e:
+            logger.error(f"Skipping guild {guild_id}: {e}")
+            continue
+        target.save_guild(guild_id, data)
+        imported += 1
+        logger.info(f"Queued import of guild {guild_id} ({len(data['counts'])} users)")
+    return imported
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] != 'import':
+        print("Usage: python storage.py import [database_path] [json_directory]")
+        sys.exit(1)
+    db_path = sys.argv[2] if len(sys.argv) > 2 else 'strack.db'
+    json_dir = sys.argv[3] if len(sys.argv) > 3 else '.'
+    storage = SqliteStorage(db_path)
+    count = import_json_files(storage, json_dir)
+    storage.close()
+    logger.info(f"Imported {count} guild file(s) into {db_path}")
@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+RETRY_DELAYS = (60, 300, 900)      # seconds before each new attempt at a timer whose firing failed
+
+
+class TimerLimitError(Exception):
+    """Raised when a user or guild already has the maximum number of pending timers."""
+
+
+class TimerScheduler:
+    """Runs every pending /timer from one task driven by a min-heap of deadlines.
+
+    Timers are plain dicts ({"id", "guild_id", "channel_id", "user_id",
+    "created", "deadline"}) persisted through the storage backend, so they
+    survive restarts; timers that came due while the bot was down fire as soon
+    as it is back, with how late they are. A timer stays in the store until it
+    has fired successfully; failed attempts are retried after RETRY_DELAYS.
+    """
+
+    def __init__(self, store, fire, max_per_user=5, max_per_guild=500, id_offset=0, id_step=1):
+        self._store = store
+        self._fire = fire                   # async fire(timer, late_by_seconds)
+        self.max_per_user = max_per_user
+        self.max_per_guild = max_per_guild
+        # Processes sharing one timer store hand out interleaved IDs (offset, offset + step, ...).
+        self.id_offset = id_offset
+        self.id_step = id_step
+        self._timers = {}                   # id -> timer
+        self._heap = []                     # (deadline, id); cancelled ids are skipped lazily
+        self._per_user = {}                 # (guild_id, user_id) -> pending count
+        self._per_guild = {}                # guild_id -> pending count
+        self._next_id = 1
+        self._wakeup = asyncio.Event()
+        self._firing = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def load(self, owns=None):
+        """Loads persisted timers. Call once before `run`.
+
+        With a store shared between processes, `owns(guild_id)` picks the
+        timers this process is responsible for firing.
+        """
+        for timer in self._store.load_timers():
+            if owns is None or owns(timer["guild_id"]):
+                self._track(timer)
+            else:
+                self._next_id = max(self._next_id, timer["id"] + 1)
+        logger.info(f"Loaded {len(self._timers)} pending timer(s)")
+
+    def _track(self, timer):
+        self._timers[timer["id"]] = timer
+        heapq.heappush(self._heap, (timer["deadline"], timer["id"]))
+        user_key = (timer["guild_id"], timer["user_id"])
+        self._per_user[user_key] = self._per_user.get(user_key, 0) + 1
+        self._per_guild[timer["guild_id"]] = self._per_guild.get(timer["guild_id"], 0) + 1
+        self._next_id = max(self._next_id, timer["id"] + 1)
+
+    def _untrack(self, timer_id):
+        timer = self._timers.pop(timer_id, None)
+        if timer is None:
+            return None
+        user_key = (timer["guild_id"], timer["user_id"])
+        for counts, key in ((self._per_user, user_key), (self._per_guild, timer["guild_id"])):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        # Cancelled entries stay in the heap until popped; compact if they pile up.
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            self._heap = [(t["deadline"], t["id"]) for t in self._timers.values()]
+            heapq.heapify(self._heap)
+        return timer
+
+    def add(self, guild_id, channel_id, user_id, seconds):
+        """Schedules a timer and returns it. Raises TimerLimitError when over a limit."""
+        if self._per_user.get((guild_id, user_id), 0) >= self.max_per_user:
+            raise TimerLimitError(f"You can only have {self.max_per_user} timers running at once.")
+        if guild_id and self._per_guild.get(guild_id, 0) >= self.max_per_guild:
+            raise TimerLimitError(f"This server already has {self.max_per_guild} timers running.")
+        now = time.time()
+        timer = {
+            "id": self._next_id + (self.id_offset - self._next_id) % self.id_step,
+            "guild_id": guild_id,
+            "channel_id": channel_id,
+            "user_id": user_id,
+            "created": now,
+            "deadline": now + seconds
+        }
+        self._track(timer)
+        self._store.add_timer(timer)
+        self._wakeup.set()
+        return timer
+
+    def cancel(self, timer_id, user_id=None):
+        """Cancels a timer (only the owner's, if user_id is given). Returns it, or None."""
+        timer = self._timers.get(timer_id)
+        if timer is None or (user_id is not None and timer["user_id"] != user_id):
+            return None
+        self._untrack(timer_id)
+        self._store.remove_timer(timer_id)
+        return timer
+
+    def pending(self, guild_id=None, user_id=None):
+        """Returns pending timers, soonest first, optionally filtered by guild and user."""
+        timers = [t for t in self._timers.values()
+                  if (guild_id is None or t["guild_id"] == guild_id) and (user_id is None or t["user_id"] == user_id)]
+        return sorted(timers, key=lambda t: t["deadline"])
+
+    async def _fire_safely(self, timer, late_by, attempt=0):
+        try:
+            await self._fire(timer, late_by)
+        except Exception as e:
+            if attempt < len(RETRY_DELAYS):
+                logger.error(f"Error firing timer {timer['id']}: {e}; retrying in {RETRY_DELAYS[attempt]}s")
+                self._track(dict(timer, deadline=time.time() + RETRY_DELAYS[attempt], attempt=attempt + 1))
+                self._wakeup.set()
+                return
+            logger.error(f"Error firing timer {timer['id']}: {e}; giving up")
+        self._store.remove_timer(timer["id"])
+
+    def start(self):
+        """Runs the scheduler in a task it keeps hold of; if the loop dies, the
+        error is logged and it is restarted."""
+        self._task = asyncio.create_task(self.run())
+        self._task.add_done_callback(self._on_stopped)
+
+    def _on_stopped(self, task):
+        if task.cancelled():
+            return
+        logger.error(f"Timer scheduler stopped unexpectedly: {task.exception()!r}; restarting it in 5s")
+        asyncio.get_running_loop().call_later(5, self.start)
+
+    async def run(self):
+        """Sleeps until the next deadline, fires everything due, and repeats."""
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and (self._heap[0][0] <= now or self._heap[0][1] not in self._timers):
+                deadline, timer_id = heapq.heappop(self._heap)
+                timer = self._untrack(timer_id)
+                if timer is None:
+                    continue
+                # Removed from the store only once it has fired (see _fire_safely).
+                task = asyncio.create_task(self._fire_safely(timer, now - deadline, timer.get("attempt", 0)))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass